@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+"""Loudness, peak, clipping, duration and silence ratio for every take.
+
+    analyze.py <recordings dir> [workers]
+
+Takes are analyzed in parallel by a pool of worker processes, one per core
+unless told otherwise. Each result is appended to <dir>.analysis.jsonl as
+soon as it's ready, so an interrupted run picks up where it stopped, and
+takes whose size and mtime haven't changed since they were last analyzed
+are skipped.
+"""
+
+# Core
+import concurrent.futures
+import json
+import os
+import sys
+
+# Community
+import numpy as np
+import soundfile as sf
+
+from vad import Detector
+
+# As listed by mem.py
+AUDIO_EXTENSIONS = (".wav", ".flac", ".ogg", ".opus")
+
+BLOCK_FRAMES = 65536
+
+# Loudness is measured over 400 ms windows every 100 ms, gated as in
+# ITU-R BS.1770 (without its K-weighting filter)
+LOUDNESS_STEP_SECONDS = 0.1
+LOUDNESS_WINDOW_STEPS = 4
+ABSOLUTE_GATE_DB = -70
+RELATIVE_GATE_DB = -10
+
+# Samples at least this loud count as clipped
+CLIP_LEVEL = 0.999
+
+def main():
+    base = sys.argv[1]
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    index = Index.load(base)
+    if index.torn:
+        index.compact()
+
+    paths = list(walk(base))
+
+    todo = []
+    for path in paths:
+        name = os.path.relpath(path, base)
+        st = os.stat(path)
+        if not index.is_current(name, st):
+            todo.append((name, path, st))
+
+    print("{} takes, {} to analyze".format(len(paths), len(todo)))
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = dict((pool.submit(analyze, path), (name, st)) for name, path, st in todo)
+
+        for future in concurrent.futures.as_completed(futures):
+            name, st = futures[future]
+            try:
+                result = future.result()
+            except (OSError, RuntimeError) as e:
+                print("{}: {}".format(name, e))
+                continue
+
+            result.update(name=name, size=st.st_size, mtime=st.st_mtime_ns)
+            index.add(result)
+
+            print("{name} {duration:.1f}s {loudness_db:.1f} dB peak {peak_db:.1f} dB "
+                    "clipped {clipped} silence {silence_ratio:.0%}".format(**result))
+
+    index.compact()
+
+def walk(base):
+    for root, dirs, files in os.walk(base):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(AUDIO_EXTENSIONS):
+                yield os.path.join(root, name)
+
+def db(power):
+    return 10 * np.log10(np.maximum(power, 1e-10))
+
+def analyze(path):
+    with sf.SoundFile(path) as f:
+        samplerate = f.samplerate
+        detector = Detector(samplerate)
+        step = int(samplerate * LOUDNESS_STEP_SECONDS)
+
+        peak = 0.0
+        clipped = 0
+        total_power = 0.0
+        voiced = 0
+        detected = 0
+        step_powers = []
+
+        # Frames left over from the previous block by the detector and by the
+        # loudness steps
+        frame_carry = np.zeros((0, f.channels), dtype="float32")
+        step_carry = frame_carry
+
+        for block in f.blocks(blocksize=BLOCK_FRAMES, dtype="float32", always_2d=True):
+            magnitude = np.abs(block)
+            peak = max(peak, float(magnitude.max()))
+            clipped += int(np.count_nonzero(magnitude >= CLIP_LEVEL))
+            total_power += float(np.sum(block * block))
+
+            data = np.concatenate([frame_carry, block])
+            n = len(data) // detector.frame
+            if n:
+                speech = detector.classify(data[:n * detector.frame].reshape(n, detector.frame, -1))
+                voiced += int(np.count_nonzero(speech))
+                detected += n
+            frame_carry = data[n * detector.frame:]
+
+            data = np.concatenate([step_carry, block])
+            steps = len(data) // step
+            if steps:
+                frames = data[:steps * step].reshape(steps, step, -1)
+                step_powers.append(np.mean(frames * frames, axis=(1, 2)))
+            step_carry = data[steps * step:]
+
+        frames = f.frames
+        channels = f.channels
+
+    return {
+        "duration": frames / samplerate,
+        "samplerate": samplerate,
+        "channels": channels,
+        "rms_db": float(db(total_power / max(1, frames * channels))),
+        "loudness_db": gated_loudness(np.concatenate(step_powers) if step_powers else np.zeros(0)),
+        "peak_db": float(db(peak * peak)),
+        "clipped": clipped,
+        "silence_ratio": 1 - voiced / detected if detected else 1.0,
+    }
+
+def gated_loudness(step_powers):
+    if len(step_powers) < LOUDNESS_WINDOW_STEPS:
+        windows = np.array([step_powers.mean()]) if len(step_powers) else np.zeros(1)
+    else:
+        windows = np.convolve(step_powers, np.ones(LOUDNESS_WINDOW_STEPS) / LOUDNESS_WINDOW_STEPS, "valid")
+
+    windows = windows[db(windows) > ABSOLUTE_GATE_DB]
+    if not len(windows):
+        return float(ABSOLUTE_GATE_DB)
+
+    relative_gate = db(windows.mean()) + RELATIVE_GATE_DB
+    windows = windows[db(windows) > relative_gate]
+
+    return float(db(windows.mean()))
+
+class Index:
+    """Results keyed by take name, appended to <base>.analysis.jsonl.
+
+    Later lines replace earlier ones for the same take. compact() rewrites
+    the file with one line per take, dropping takes that no longer exist
+    and any line cut off by an interrupted run.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.path = os.path.normpath(base) + ".analysis.jsonl"
+        self.results = {}
+        self.lines = 0
+        self.torn = False
+
+    @staticmethod
+    def load(base):
+        index = Index(base)
+
+        try:
+            with open(index.path, "r") as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        result = None
+
+                    if result is None or not line.endswith("\n"):
+                        # Appending after it would garble the next line too
+                        index.torn = True
+                        continue
+
+                    index.results[result["name"]] = result
+                    index.lines += 1
+        except OSError:
+            pass
+
+        return index
+
+    def is_current(self, name, st):
+        result = self.results.get(name)
+
+        return (result is not None and result["size"] == st.st_size and
+                result["mtime"] == st.st_mtime_ns)
+
+    def add(self, result):
+        self.results[result["name"]] = result
+
+        with open(self.path, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+        self.lines += 1
+
+    def compact(self):
+        for name in list(self.results):
+            if not os.path.exists(os.path.join(self.base, name)):
+                del self.results[name]
+
+        if self.lines == len(self.results) and not self.torn:
+            return
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for name in sorted(self.results):
+                f.write(json.dumps(self.results[name]) + "\n")
+
+        os.replace(tmp, self.path)
+        self.lines = len(self.results)
+        self.torn = False
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Re-encodes finished takes to a compressed format in the background.
+
+Encoding runs in a pool of worker processes at the lowest CPU priority, so
+it never competes with recording or playback. A worker only writes the new
+file; swapping it in for the original is left to the caller, which owns the
+list of takes.
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+
+import soundfile as sf
+
+# Extension, libsndfile format and subtype
+FORMATS = {
+    "flac": (".flac", "FLAC", "PCM_24"),
+    "vorbis": (".ogg", "OGG", "VORBIS"),
+    "opus": (".opus", "OGG", "OPUS"),
+}
+
+# Opus only supports these sample rates
+OPUS_RATES = (8000, 12000, 16000, 24000, 48000)
+
+BLOCK_FRAMES = 65536
+
+def archive_path(path, fmt):
+    return os.path.splitext(path)[0] + FORMATS[fmt][0]
+
+def lower_priority():
+    if hasattr(os, "nice"):
+        os.nice(19)
+
+def compress(path, fmt):
+    """Write a compressed copy of path; return the copy's path."""
+    ext, major, subtype = FORMATS[fmt]
+    dest = archive_path(path, fmt)
+    tmp = dest + ".tmp"
+
+    with sf.SoundFile(path) as src:
+        if subtype == "OPUS" and src.samplerate not in OPUS_RATES:
+            raise ValueError("Opus can't encode {} Hz audio".format(src.samplerate))
+
+        with sf.SoundFile(tmp, mode="w", samplerate=src.samplerate, channels=src.channels,
+                format=major, subtype=subtype) as out:
+            for block in src.blocks(blocksize=BLOCK_FRAMES, dtype="float32", always_2d=True):
+                out.write(block)
+
+        frames = src.frames
+
+    if sf.info(tmp).frames != frames:
+        os.remove(tmp)
+        raise RuntimeError("Compressed copy of {} is incomplete".format(path))
+
+    # Keep the take's time, which also keeps its peaks file up to date
+    st = os.stat(path)
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp, dest)
+
+    return dest
+
+class Archiver:
+    """Compresses takes to fmt; done() returns the (original, copy) pairs finished."""
+
+    def __init__(self, fmt="flac", workers=None):
+        self.fmt = fmt
+        # Spawned rather than forked: the caller has threads and audio streams
+        self.pool = concurrent.futures.ProcessPoolExecutor(workers,
+                mp_context=multiprocessing.get_context("spawn"), initializer=lower_priority)
+        self.pending = {}
+        self.failed = 0
+
+    def wants(self, path):
+        # Only uncompressed takes; re-encoding a lossy one gains nothing
+        return path.lower().endswith(".wav") and path not in self.pending
+
+    def submit(self, path):
+        if self.wants(path):
+            self.pending[path] = self.pool.submit(compress, path, self.fmt)
+
+    def done(self):
+        finished = []
+        for path, future in list(self.pending.items()):
+            if not future.done():
+                continue
+
+            del self.pending[path]
+            try:
+                finished.append((path, future.result()))
+            except (OSError, RuntimeError, ValueError):
+                self.failed += 1
+
+        return finished
+
+    def shutdown(self):
+        """Drop the queued takes and wait for the ones being encoded."""
+        self.pool.shutdown(wait=True, cancel_futures=True)
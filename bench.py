@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+"""Headless benchmarks for the text and audio hot paths.
+
+    bench.py [output.json] [max corpus bytes]
+
+Runs without a display or audio device: pygame uses its dummy drivers and
+sounddevice is replaced with a stream that never produces audio, so the
+recorder is fed blocks directly. Results are written as JSON, one entry per
+measurement, so runs from different versions can be diffed.
+"""
+
+# Core
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+# Community
+import numpy as np
+
+SIZES = [1000, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7, 10 ** 8]
+BLOCK_SIZES = [64, 256, 1024, 4096]
+
+# Seconds of audio pushed through the recorder per block size
+RECORD_SECONDS = 30
+
+WORDS = ("the foundation of all good qualities is kind and venerable guru "
+        "correct devotion to him root path by clearly seeing this applying "
+        "great effort please bless me rely upon with respect").split()
+
+def main():
+    output = sys.argv[1] if len(sys.argv) > 1 else "bench.json"
+    max_size = int(sys.argv[2]) if len(sys.argv) > 2 else SIZES[-1]
+
+    install_fake_sounddevice()
+
+    import game
+    import mem
+    import corpus_index
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        for size in [s for s in SIZES if s <= max_size]:
+            path = write_corpus(os.path.join(workdir, "corpus-{}.txt".format(size)), size)
+            results += bench_corpus(game, corpus_index, path, size)
+
+        verse = os.path.join(workdir, "verse.txt")
+        write_corpus(verse, 10 ** 4)
+        results += bench_text(game, verse)
+
+        for block_size in BLOCK_SIZES:
+            results.append(bench_recorder(mem, workdir, block_size))
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+    with open(output, "w") as f:
+        json.dump(report, f, indent=1)
+
+    for entry in results:
+        print("{name:32} {size:>10} {seconds:.6f}s".format(**entry))
+
+def install_fake_sounddevice():
+    class InputStream:
+
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def start(self):
+            pass
+
+        def stop(self):
+            pass
+
+        def close(self):
+            pass
+
+    sd = types.ModuleType("sounddevice")
+    sd.InputStream = InputStream
+    sd.OutputStream = InputStream
+    sd.CallbackStop = Exception
+    sys.modules["sounddevice"] = sd
+
+def write_corpus(path, size):
+    rng = random.Random(size)
+
+    written = 0
+    with open(path, "w") as f:
+        while written < size:
+            if rng.random() < 0.1:
+                line = "\n"
+            else:
+                line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))) + "\n"
+
+            f.write(line)
+            written += len(line)
+
+    return path
+
+def timed(fn, repeat=1):
+    """Run fn repeat times; return the median seconds and the last result."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = fn()
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times), value
+
+def result(name, size, seconds, **extra):
+    entry = {"name": name, "size": size, "seconds": seconds}
+    entry.update(extra)
+    return entry
+
+def bench_corpus(game, corpus_index, path, size):
+    repeat = 5 if size <= 10 ** 6 else 1
+    results = []
+
+    seconds, _ = timed(lambda: corpus_index.compile(path), repeat)
+    results.append(result("corpus_index.compile", size, seconds))
+
+    seconds, index = timed(lambda: game.load_file(path))
+    results.append(result("load_file cold", size, seconds))
+
+    seconds, index = timed(lambda: game.load_file(path), repeat)
+    results.append(result("load_file warm", size, seconds))
+
+    seconds, _ = timed(lambda: game.Game(index), repeat)
+    results.append(result("Game.__init__", size, seconds, lines=index.line_count))
+
+    with open(path) as f:
+        text = f.read().split("\n")
+
+    seconds, pages = timed(lambda: corpus_index.make_pager(text, 26, 7), repeat)
+    results.append(result("make_pager", size, seconds, pages=len(pages)))
+
+    seconds, _ = timed(lambda: [corpus_index.initials(page) for page in pages], repeat)
+    results.append(result("initials", size, seconds))
+
+    os.remove(path + ".idx")
+
+    return results
+
+def bench_text(game, path):
+    results = []
+
+    with open(path) as f:
+        verse = " ".join(f.read().split())[:2000]
+
+    rect = game.Rect((20, 20), (760, 560))
+
+    def draw_cold():
+        game.layout_cache.clear()
+        game.font_metrics_cache.clear()
+        game.text_cache.surfaces.clear()
+        return game.draw_text(game.screen, verse, game.GRAY, rect, game.font)
+
+    seconds, _ = timed(draw_cold, 20)
+    results.append(result("draw_text cold", len(verse), seconds))
+
+    seconds, _ = timed(lambda: game.draw_text(game.screen, verse, game.GRAY, rect, game.font), 100)
+    results.append(result("draw_text warm", len(verse), seconds))
+
+    g = game.Game(game.load_file(path), 4)
+    scene = game.Scene(game.screen, game.background)
+
+    for cls in (game.Menu, game.Initialisms, game.Blank, game.GuessNext):
+        state = cls(g)
+
+        def tick_cold():
+            scene.invalidate()
+            return scene.render(state.view())
+
+        seconds, _ = timed(tick_cold, 50)
+        results.append(result(cls.__name__ + " tick cold", len(g.lines), seconds))
+
+        seconds, _ = timed(lambda: scene.render(state.view()), 200)
+        results.append(result(cls.__name__ + " tick idle", len(g.lines), seconds))
+
+    os.remove(path + ".idx")
+
+    return results
+
+def bench_recorder(mem, workdir, block_size):
+    path = os.path.join(workdir, "take-{}.wav".format(block_size))
+    block = (np.random.rand(block_size, mem.CHANNELS).astype("float32") - 0.5)
+    blocks = RECORD_SECONDS * mem.SAMPLE_RATE // block_size
+
+    rec = mem.Recorder()
+    rec.start(path)
+
+    start = time.perf_counter()
+    callback_seconds = 0
+    for _ in range(blocks):
+        # Unlike a real device we can outrun the writer, so wait for room
+        while rec.buffer.available + block_size > rec.buffer.size:
+            time.sleep(0.001)
+
+        callback_start = time.perf_counter()
+        rec.callback(block, block_size, None, None)
+        callback_seconds += time.perf_counter() - callback_start
+
+    rec.stop()
+    rec.wait()
+    seconds = time.perf_counter() - start
+
+    frames = blocks * block_size
+    return result("Recorder block={}".format(block_size), frames, seconds,
+            callback_seconds=callback_seconds, frames_per_second=frames / seconds)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+"""Compares a practice take with a reference take of the same recitation.
+
+    compare.py <practice take> <reference take>
+
+Both takes are reduced to a frame of features every HOP_SECONDS: log energy
+and MFCC-like cepstral coefficients. They are aligned with dynamic time
+warping, restricted to a Sakoe-Chiba band of BAND_SECONDS either side of
+the diagonal, so time and memory grow with the length times the band rather
+than the length squared. The report lists where the practice take diverges
+from the reference, where it runs faster or slower, and the parts of the
+reference it skips or the material it adds.
+"""
+
+# Core
+import sys
+
+# Community
+import numpy as np
+import soundfile as sf
+
+HOP_SECONDS = 0.04
+WINDOW_SECONDS = 0.08
+
+MEL_BANDS = 26
+CEPSTRA = 13
+ENERGY_WEIGHT = 2.0
+
+# How far, in seconds, the alignment may wander from the straight line
+# between the starts and ends of the takes; a skipped or repeated verse
+# must fit in it
+BAND_SECONDS = 30
+
+# Rows of the cost matrix computed at once
+COST_ROWS = 64
+
+# Path cost, averaged over a second, this many times the median counts as
+# diverging
+DIVERGE_FACTOR = 2.5
+SMOOTH_SECONDS = 1.0
+
+# Tempo is measured over windows this long, and reported when it's off by
+# more than the tolerance
+TEMPO_SECONDS = 5.0
+TEMPO_TOLERANCE = 0.15
+
+# Shortest skipped or added stretch worth reporting
+SKIP_SECONDS = 1.0
+
+def hz_to_mel(hz):
+    return 2595 * np.log10(1 + hz / 700)
+
+def mel_to_hz(mel):
+    return 700 * (10 ** (mel / 2595) - 1)
+
+def mel_filters(samplerate, nfft):
+    edges = mel_to_hz(np.linspace(0, hz_to_mel(samplerate / 2), MEL_BANDS + 2))
+    bins = np.fft.rfftfreq(nfft, 1 / samplerate)
+
+    lower, center, upper = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+    rising = (bins - lower) / (center - lower)
+    falling = (upper - bins) / (upper - center)
+
+    return np.maximum(0, np.minimum(rising, falling))
+
+def dct_matrix():
+    n = np.arange(MEL_BANDS)
+    k = np.arange(CEPSTRA)[:, None]
+    return np.cos(np.pi * k * (2 * n + 1) / (2 * MEL_BANDS))
+
+def features(path, block_frames=256):
+    """Feature frames of a take, one row per HOP_SECONDS, plus its hop in seconds."""
+    info = sf.info(path)
+    hop = int(info.samplerate * HOP_SECONDS)
+    window = int(info.samplerate * WINDOW_SECONDS)
+    nfft = 1 << (window - 1).bit_length()
+
+    filters = mel_filters(info.samplerate, nfft)
+    dct = dct_matrix()
+    taper = np.hanning(window).astype("float32")
+
+    energies = []
+    cepstra = []
+
+    # Blocks overlap by a window less a hop, so frames run on across them
+    blocks = sf.blocks(path, blocksize=hop * block_frames + window - hop,
+            overlap=window - hop, dtype="float32", always_2d=True)
+    for block in blocks:
+        mono = block.mean(axis=1)
+        if len(mono) < window:
+            break
+
+        frames = np.lib.stride_tricks.sliding_window_view(mono, window)[::hop]
+        power = np.abs(np.fft.rfft(frames * taper, nfft)) ** 2
+
+        energies.append(np.log(np.sum(frames * frames, axis=1) + 1e-10))
+        cepstra.append(np.log(power @ filters.T + 1e-10) @ dct.T)
+
+    if not energies:
+        return np.zeros((0, CEPSTRA), dtype="float32"), HOP_SECONDS
+
+    energy = np.concatenate(energies)
+    cepstrum = np.concatenate(cepstra)[:, 1:]
+
+    # Normalize per take, so different microphones and levels still match
+    energy = (energy - energy.mean()) / (energy.std() + 1e-10)
+    cepstrum = (cepstrum - cepstrum.mean(axis=0)) / (cepstrum.std(axis=0) + 1e-10)
+
+    frames = np.hstack([ENERGY_WEIGHT * energy[:, None], cepstrum]).astype("float32")
+    return frames, hop / info.samplerate
+
+def band(n, m, radius):
+    """First column and width of the band for each of n rows."""
+    center = np.round(np.arange(n) * ((m - 1) / max(1, n - 1))).astype(int)
+    width = min(m, 2 * radius + 1)
+
+    return np.clip(center - radius, 0, m - width), width
+
+def costs(a, b, lo, width, rows):
+    """Squared distances from each of a[rows] to the band of b on its row."""
+    cols = lo[rows, None] + np.arange(width)
+    diff = a[rows, None, :] - b[cols]
+
+    return np.einsum("ijk,ijk->ij", diff, diff)
+
+def align(a, b, radius):
+    """Banded DTW of feature frames a against b.
+
+    Returns the path as arrays of row and column indices, from (0, 0) to
+    the last frame of each. A row's horizontal moves all end on the same
+    cell's minimum, so each row is a prefix-minimum over its band rather
+    than a loop over columns. Only the previous row of costs is kept; the
+    way back is kept as one int16 per cell of the band.
+    """
+    n, m = len(a), len(b)
+    lo, width = band(n, m, radius)
+    cols = np.arange(width)
+
+    # Twice the length of the horizontal run into a cell, plus one when the
+    # run starts with a vertical step rather than a diagonal one
+    back = np.empty((n, width), dtype="int16")
+
+    previous = None
+    for start in range(0, n, COST_ROWS):
+        rows = np.arange(start, min(n, start + COST_ROWS))
+        block = costs(a, b, lo, width, rows)
+
+        for i, cost in zip(rows, block):
+            prefix = np.cumsum(cost)
+
+            if previous is None:
+                entry = np.full(width, np.inf)
+                entry[0] = cost[0]
+                vertical = np.zeros(width, dtype=bool)
+            else:
+                # The previous row's cells above and above-left of each column
+                shift = lo[i] - lo[i - 1]
+                above = np.full(width + 1, np.inf)
+                src = cols + shift
+                valid = src < width
+                above[1:][valid] = previous[src[valid]]
+                if 0 < shift <= width:
+                    above[0] = previous[shift - 1]
+
+                vertical = above[1:] < above[:-1]
+                entry = cost + np.minimum(above[1:], above[:-1])
+
+            # current[j] = min over k <= j of entry[k] + cost[k + 1..j]
+            shifted = entry - prefix
+            best = np.minimum.accumulate(shifted)
+            current = best + prefix
+
+            first = np.maximum.accumulate(np.where(shifted == best, cols, 0))
+            back[i] = (cols - first) * 2 + vertical[first]
+
+            previous = current
+
+    path_i = []
+    path_j = []
+    i, j = n - 1, m - 1
+    while True:
+        code = int(back[i, j - lo[i]])
+        run = code >> 1
+
+        path_i.extend([i] * (run + 1))
+        path_j.extend(range(j, j - run - 1, -1))
+        j -= run
+
+        if i == 0:
+            break
+
+        i -= 1
+        if not code & 1:
+            j -= 1
+
+    return np.array(path_i[::-1]), np.array(path_j[::-1])
+
+def regions(mask):
+    """(start, end) index pairs of the runs of True in mask."""
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], mask.astype(np.int8), [0]])))
+    return list(zip(edges[::2], edges[1::2]))
+
+class Report:
+    """What an alignment says about a practice take, in seconds."""
+
+    def __init__(self, practice_seconds, reference_seconds, cost):
+        self.practice_seconds = practice_seconds
+        self.reference_seconds = reference_seconds
+        self.cost = cost
+
+        # (practice start, practice end, reference start, reference end)
+        self.divergences = []
+
+        # (practice start, practice end, reference seconds per practice second)
+        self.drifts = []
+
+        # (practice time, reference start, reference end)
+        self.skips = []
+
+        # (practice start, practice end, reference time)
+        self.insertions = []
+
+    @property
+    def tempo(self):
+        """Reference seconds per practice second; above 1 is faster than the reference."""
+        return self.reference_seconds / self.practice_seconds if self.practice_seconds else 0.0
+
+    def summary(self):
+        lines = ["{:.1f}s against {:.1f}s, tempo x{:.2f}, cost {:.2f}".format(
+                self.practice_seconds, self.reference_seconds, self.tempo, self.cost)]
+
+        for p0, p1, r0, r1 in self.divergences:
+            lines.append("diverges {} - {} (reference {} - {})".format(
+                    clock(p0), clock(p1), clock(r0), clock(r1)))
+
+        for p0, p1, ratio in self.drifts:
+            lines.append("{} {} - {} (x{:.2f})".format(
+                    "rushes" if ratio > 1 else "drags", clock(p0), clock(p1), ratio))
+
+        for p, r0, r1 in self.skips:
+            lines.append("skips reference {} - {} at {}".format(clock(r0), clock(r1), clock(p)))
+
+        for p0, p1, r in self.insertions:
+            lines.append("adds {} - {} (reference {})".format(clock(p0), clock(p1), clock(r)))
+
+        return lines
+
+def clock(seconds):
+    tenths = int(round(seconds * 10))
+    return "{}:{:02}.{}".format(tenths // 600, tenths % 600 // 10, tenths % 10)
+
+def compare(practice_path, reference_path):
+    a, hop = features(practice_path)
+    b, reference_hop = features(reference_path)
+    if not len(a) or not len(b):
+        return Report(len(a) * hop, len(b) * reference_hop, 0.0)
+
+    path_i, path_j = align(a, b, int(BAND_SECONDS / hop))
+    return report(a, b, path_i, path_j, hop)
+
+def report(a, b, path_i, path_j, hop):
+    n = len(a)
+    cell_costs = np.sum((a[path_i] - b[path_j]) ** 2, axis=1)
+
+    result = Report(n * hop, len(b) * hop, float(cell_costs.mean()))
+
+    # Per practice frame: mean cost and the reference frames it covers
+    row_costs = np.bincount(path_i, cell_costs, n) / np.bincount(path_i, minlength=n)
+    ref_start = np.full(n, len(b))
+    ref_end = np.zeros(n, dtype=int)
+    np.minimum.at(ref_start, path_i, path_j)
+    np.maximum.at(ref_end, path_i, path_j)
+
+    smooth = max(1, int(SMOOTH_SECONDS / hop))
+    smoothed = np.convolve(row_costs, np.ones(smooth) / smooth, "same")
+    for p0, p1 in regions(smoothed > DIVERGE_FACTOR * np.median(smoothed)):
+        result.divergences.append((p0 * hop, p1 * hop, ref_start[p0] * hop, ref_end[p1 - 1] * hop))
+
+    skip = int(SKIP_SECONDS / hop)
+    skipped = ref_end - ref_start >= skip
+
+    # Consecutive practice frames all matched to one reference frame
+    held = np.concatenate([[False], (ref_start[1:] == ref_end[:-1]) & (ref_start[1:] == ref_end[1:])])
+    added = np.zeros(n, dtype=bool)
+    for p0, p1 in regions(held):
+        if p1 - p0 >= skip:
+            added[p0:p1] = True
+            result.insertions.append((p0 * hop, p1 * hop, ref_start[p0] * hop))
+
+    # A long skip can be taken in a few jumps a frame or two apart
+    last = None
+    for p in np.flatnonzero(skipped):
+        if last is not None and p - last <= skip:
+            p0, r0, _ = result.skips.pop()
+        else:
+            p0, r0 = p * hop, ref_start[p] * hop
+
+        result.skips.append((p0, r0, ref_end[p] * hop))
+        last = p
+
+    # Reference frames covered per practice frame, with skips and additions
+    # counted as keeping the overall tempo so they don't also show as drift
+    advance = np.diff(ref_end, prepend=0).astype(float)
+    advance[skipped | added] = result.tempo
+    covered = np.cumsum(advance)
+
+    window = int(TEMPO_SECONDS / hop)
+    if n > window:
+        ratio = (covered[window:] - covered[:-window]) / window
+        off = np.abs(ratio - result.tempo) > TEMPO_TOLERANCE * result.tempo
+
+        # Practice frames inside any window that's off, so overlapping
+        # windows are reported once
+        inside = np.convolve(off, np.ones(window)) > 0
+        for p0, p1 in regions(inside):
+            windows = ratio[p0:max(p0 + 1, p1 - window + 1)]
+            result.drifts.append((p0 * hop, p1 * hop, float(windows.mean())))
+
+    return result
+
+def main():
+    for line in compare(sys.argv[1], sys.argv[2]).summary():
+        print(line)
+
+if __name__ == "__main__":
+    main()
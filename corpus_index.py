@@ -0,0 +1,468 @@
+"""Compiled corpus index, stored next to the text it was built from.
+
+Shared by game.py and pygamer/text_viewer.py (copy it to the device along
+with the script). The index is a single file of little-endian sections:
+
+    header         magic, version, source size, mtime and crc32,
+                   page width and height (0 if not paged)
+    counts         lines, tokens, vocab words, vocab bytes, pages, page bytes,
+                   initials bytes, folded words, folded bytes, followers,
+                   longest folded word, first letters
+    lines          (start, end) byte offsets of every non-blank source line
+    line_tokens    offset of each line's first token, plus an end marker
+    tokens         vocab id of every token
+    vocab_offsets  offsets into the vocab blob, plus an end marker
+    page_offsets   offsets into the pages blob, plus an end marker
+    initials_offsets  the same for the initials blob
+    folds          folded id of every vocab word
+    folded_offsets    offsets into the folded blob, plus an end marker
+    follower_offsets  offset of each folded word's followers, plus an end marker
+    followers      folded ids of the words that follow each folded word
+    length_offsets offset of each word length in by_length, plus an end marker
+    by_length      folded ids ordered by length
+    letters        first letters of the folded words, as code points
+    letter_offsets first folded id starting with each letter, plus an end marker
+    vocab          interned words, utf-8
+    pages          pre-wrapped pages, utf-8
+    initials       every page reduced to its words' initials, utf-8
+    folded         distinct lowercased words in sorted order, utf-8
+
+Folded words are sorted, so the words starting with a letter are a run of
+ids and a word can be found by bisection.
+
+The integer sections are read in place (memory-mapped where the platform
+has mmap), so opening an index doesn't re-parse the text.
+"""
+
+import os
+import struct
+from array import array
+
+from files import replace_file
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+try:
+    from zlib import crc32
+except ImportError:
+    from binascii import crc32
+
+MAGIC = b"OTIX"
+VERSION = 3
+
+HEADER = "<4sIIIIII"
+COUNTS = "<IIIIIIIIIIII"
+
+BLOBS = ("vocab", "pages", "initials", "folded")
+HEADER_SIZE = struct.calcsize(HEADER) + struct.calcsize(COUNTS)
+
+def load(path, max_width=0, max_height=0, pager=None, index_path=None):
+    """Open the index for path, (re)compiling it if it is missing or stale.
+
+    Pages are only compiled when a pager is given; pager(lines, max_width,
+    max_height) must return the pages as strings.
+    """
+    if index_path is None:
+        index_path = path + ".idx"
+
+    try:
+        index = CorpusIndex.open(index_path)
+    except (OSError, ValueError):
+        index = None
+
+    if index is not None:
+        if index.matches(path, max_width, max_height, pager is not None):
+            return index
+
+        index.close()
+
+    data = compile(path, max_width, max_height, pager)
+
+    # Write a temp file and rename it, so an interrupted write can't leave
+    # a truncated index behind
+    tmp_path = index_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+
+        replace_file(tmp_path, index_path)
+    except OSError:
+        # Read-only volume, keep the index in memory for this session
+        return CorpusIndex(data)
+
+    return CorpusIndex.open(index_path)
+
+def source_stat(path):
+    st = os.stat(path)
+    return st[6], int(st[8])
+
+def source_crc(path):
+    crc = 0
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(65536)
+            if not block:
+                break
+
+            crc = crc32(block, crc)
+
+    return crc & 0xFFFFFFFF
+
+def compile(path, max_width=0, max_height=0, pager=None):
+    """Build the index for path and return it as bytes."""
+    with open(path, "rb") as f:
+        source = f.read()
+
+    size, mtime = source_stat(path)
+
+    lines = array("I")
+    line_tokens = array("I")
+    tokens = array("I")
+
+    vocab_ids = {}
+    vocab = []
+
+    start = 0
+    for raw in source.split(b"\n"):
+        end = start + len(raw)
+
+        if raw.strip():
+            lines.append(start)
+            lines.append(end)
+            line_tokens.append(len(tokens))
+
+            for word in raw.decode("utf-8").split():
+                word_id = vocab_ids.get(word)
+                if word_id is None:
+                    word_id = vocab_ids[word] = len(vocab)
+                    vocab.append(word)
+
+                tokens.append(word_id)
+
+        start = end + 1
+
+    line_tokens.append(len(tokens))
+
+    vocab_offsets, vocab_blob = pack_strings(vocab)
+
+    if pager is None:
+        max_width = max_height = 0
+        pages = []
+    else:
+        text = source.decode("utf-8")
+        if text.endswith("\n"):
+            text = text[:-1]
+
+        pages = pager(text.split("\n"), max_width, max_height)
+
+    page_offsets, page_blob = pack_strings(pages)
+    initials_offsets, initials_blob = pack_strings([initials(page) for page in pages])
+
+    folded, folds = fold(vocab)
+    folded_offsets, folded_blob = pack_strings(folded)
+    follower_offsets, followers = bigrams(folds, line_tokens, tokens, len(folded))
+    length_offsets, by_length = buckets([len(word) for word in folded])
+    letters, letter_offsets = runs([ord(word[0]) for word in folded])
+
+    header = struct.pack(HEADER, MAGIC, VERSION, size, mtime,
+            crc32(source) & 0xFFFFFFFF, max_width, max_height)
+    counts = struct.pack(COUNTS, len(lines) // 2, len(tokens), len(vocab),
+            len(vocab_blob), len(pages), len(page_blob), len(initials_blob),
+            len(folded), len(folded_blob), len(followers),
+            len(length_offsets) - 2, len(letters))
+
+    return b"".join([header, counts, to_bytes(lines), to_bytes(line_tokens),
+            to_bytes(tokens), to_bytes(vocab_offsets), to_bytes(page_offsets),
+            to_bytes(initials_offsets), to_bytes(folds), to_bytes(folded_offsets),
+            to_bytes(follower_offsets), to_bytes(followers), to_bytes(length_offsets),
+            to_bytes(by_length), to_bytes(letters), to_bytes(letter_offsets),
+            vocab_blob, page_blob, initials_blob, folded_blob])
+
+def fold(vocab):
+    """Distinct lowercased words in sorted order, and each vocab word's id among them."""
+    folded = sorted(set([word.lower() for word in vocab]))
+    ids = dict((word, i) for i, word in enumerate(folded))
+
+    return folded, array("I", [ids[word.lower()] for word in vocab])
+
+def bigrams(folds, line_tokens, tokens, count):
+    """The distinct folded words following each folded word within a line.
+
+    Returns offsets into the followers array, one per folded word plus an
+    end marker, and the followers themselves in order.
+    """
+    pairs = set()
+    for i in range(len(line_tokens) - 1):
+        prev = None
+        for t in range(line_tokens[i], line_tokens[i + 1]):
+            word_id = folds[tokens[t]]
+            if prev is not None:
+                pairs.add(prev * count + word_id)
+
+            prev = word_id
+
+    offsets = array("I", bytes(4 * (count + 1)))
+    followers = array("I")
+    for pair in sorted(pairs):
+        offsets[pair // count + 1] += 1
+        followers.append(pair % count)
+
+    for i in range(count):
+        offsets[i + 1] += offsets[i]
+
+    return offsets, followers
+
+def buckets(keys):
+    """Ids ordered by their small integer key, and the offset of each key's run."""
+    order = array("I", sorted(range(len(keys)), key=lambda i: keys[i]))
+
+    offsets = array("I", bytes(4 * ((max(keys) if keys else 0) + 2)))
+    for key in keys:
+        offsets[key + 1] += 1
+
+    for i in range(len(offsets) - 1):
+        offsets[i + 1] += offsets[i]
+
+    return offsets, order
+
+def runs(keys):
+    """Distinct values of sorted keys, and where each one's run starts."""
+    values = array("I")
+    offsets = array("I")
+    for i, key in enumerate(keys):
+        if not values or values[-1] != key:
+            values.append(key)
+            offsets.append(i)
+
+    offsets.append(len(keys))
+
+    return values, offsets
+
+def make_pager(lines, max_width, max_height):
+    """Word-wrap lines into pages of max_height rows of max_width characters.
+
+    Blank lines are kept as a row with a single space, and words longer than
+    a row are broken across rows.
+    """
+    rows = []
+    for line in lines:
+        words = line.split()
+        if not words:
+            rows.append(" ")
+            continue
+
+        row = []
+        width = 0
+        for word in words:
+            while len(word) > max_width:
+                if row:
+                    rows.append(" ".join(row))
+                    row = []
+
+                rows.append(word[:max_width])
+                word = word[max_width:]
+
+            if row and width + 1 + len(word) > max_width:
+                rows.append(" ".join(row))
+                row = []
+
+            width = width + 1 + len(word) if row else len(word)
+            row.append(word)
+
+        if row:
+            rows.append(" ".join(row))
+
+    return ["".join([row + "\n" for row in rows[i:i + max_height]])
+            for i in range(0, len(rows), max_height)]
+
+def initials(text):
+    """Keep the first letter of every word, and all spaces and newlines."""
+    kept = []
+    last_space = True
+    for current in text:
+        is_space = current in " \n"
+        if last_space or is_space:
+            kept.append(current)
+
+        last_space = is_space
+
+    return "".join(kept)
+
+def pack_strings(strings):
+    offsets = array("I", [0])
+    blobs = []
+
+    size = 0
+    for s in strings:
+        blob = s.encode("utf-8")
+        size += len(blob)
+        offsets.append(size)
+        blobs.append(blob)
+
+    return offsets, b"".join(blobs)
+
+def to_bytes(arr):
+    return bytes(memoryview(arr))
+
+class CorpusIndex:
+
+    def __init__(self, buf=None, file=None):
+        self.buf = buf
+        self.file = file
+        self.vocab_words = None
+
+        header = self.read(0, HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise ValueError("truncated corpus index")
+
+        split = struct.calcsize(HEADER)
+        (magic, version, self.source_size, self.source_mtime, self.source_crc,
+                self.max_width, self.max_height) = struct.unpack(HEADER, header[:split])
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a corpus index")
+
+        (self.line_count, self.token_count, self.vocab_count, vocab_bytes,
+                self.page_count, page_bytes, initials_bytes, self.folded_count,
+                folded_bytes, follower_count, self.max_length,
+                letter_count) = struct.unpack(COUNTS, header[split:])
+
+        # (name, element count) in file order; blobs are sized in bytes
+        layout = [
+            ("lines", 2 * self.line_count),
+            ("line_tokens", self.line_count + 1),
+            ("tokens", self.token_count),
+            ("vocab_offsets", self.vocab_count + 1),
+            ("page_offsets", self.page_count + 1),
+            ("initials_offsets", self.page_count + 1),
+            ("folds", self.vocab_count),
+            ("folded_offsets", self.folded_count + 1),
+            ("follower_offsets", self.folded_count + 1),
+            ("followers", follower_count),
+            ("length_offsets", self.max_length + 2),
+            ("by_length", self.folded_count),
+            ("letters", letter_count),
+            ("letter_offsets", letter_count + 1),
+            ("vocab", vocab_bytes),
+            ("pages", page_bytes),
+            ("initials", initials_bytes),
+            ("folded", folded_bytes),
+        ]
+
+        self.sections = {}
+        pos = HEADER_SIZE
+        for name, count in layout:
+            size = count if name in BLOBS else 4 * count
+            self.sections[name] = (pos, size)
+            pos += size
+
+        if self.size() < pos:
+            raise ValueError("truncated corpus index")
+
+        self.arrays = {}
+
+    @staticmethod
+    def open(path):
+        f = open(path, "rb")
+
+        if mmap is None:
+            try:
+                return CorpusIndex(file=f)
+            except ValueError:
+                f.close()
+                raise
+
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file, let the header check reject it
+            buf = b""
+        finally:
+            f.close()
+
+        try:
+            return CorpusIndex(buf)
+        except ValueError:
+            if hasattr(buf, "close"):
+                buf.close()
+            raise
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        elif hasattr(self.buf, "close"):
+            self.buf.close()
+
+    def matches(self, path, max_width=0, max_height=0, paged=False):
+        """Whether this index is up to date for path and the page size."""
+        if paged and (self.max_width, self.max_height) != (max_width, max_height):
+            return False
+
+        size, mtime = source_stat(path)
+        if size != self.source_size:
+            return False
+
+        # Touched but maybe not changed, fall back to the checksum
+        return mtime == self.source_mtime or source_crc(path) == self.source_crc
+
+    def size(self):
+        if self.file is None:
+            return len(self.buf)
+
+        self.file.seek(0, 2)
+        return self.file.tell()
+
+    def read(self, start, size):
+        if self.file is None:
+            return self.buf[start:start + size]
+
+        self.file.seek(start)
+        return self.file.read(size)
+
+    def array(self, name):
+        arr = self.arrays.get(name)
+        if arr is not None:
+            return arr
+
+        start, size = self.sections[name]
+        if self.file is None:
+            try:
+                arr = memoryview(self.buf)[start:start + size].cast("I")
+            except (AttributeError, TypeError):
+                arr = array("I", self.buf[start:start + size])
+        else:
+            arr = array("I", bytes(size))
+            self.file.seek(start)
+            self.file.readinto(arr)
+
+        self.arrays[name] = arr
+        return arr
+
+    def string(self, section, offsets, i):
+        start = self.sections[section][0]
+        offsets = self.array(offsets)
+        return self.read(start + offsets[i], offsets[i + 1] - offsets[i]).decode("utf-8")
+
+    @property
+    def vocab(self):
+        if self.vocab_words is None:
+            self.vocab_words = [self.string("vocab", "vocab_offsets", i)
+                    for i in range(self.vocab_count)]
+
+        return self.vocab_words
+
+    def line_words(self, i):
+        line_tokens = self.array("line_tokens")
+        tokens = self.array("tokens")
+        vocab = self.vocab
+
+        return [vocab[tokens[t]] for t in range(line_tokens[i], line_tokens[i + 1])]
+
+    def page(self, i):
+        return self.string("pages", "page_offsets", i)
+
+    def page_initials(self, i):
+        return self.string("initials", "initials_offsets", i)
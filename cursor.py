@@ -0,0 +1,125 @@
+"""Cursors over lists and flat token arrays.
+
+Shared by game.py and the pygamer scripts (copy it to the device along with
+them). A whole corpus is held as three buffers: an array of vocab ids per
+token, an array of each line's first token, and the vocab list itself.
+"""
+
+class Cursor:
+    """Position in a sequence, clamped to its bounds.
+
+    Subclasses provide __len__ and __getitem__.
+    """
+
+    __slots__ = ()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def join(self, s=" "):
+        return s.join(self)
+
+    def goto(self, pos):
+        if pos < 0:
+            self.idx = max(0, self.max_idx + pos)
+        else:
+            self.idx = min(self.max_idx, pos)
+
+    def next(self, count=1):
+        self.idx = min(self.max_idx, self.idx + count)
+
+    def back(self, count=1):
+        self.idx = max(0, self.idx - count)
+
+    @property
+    def peek_next(self):
+        if self.idx == self.max_idx:
+            return None
+
+        return self[self.idx + 1]
+
+    @property
+    def current(self):
+        return self[self.idx]
+
+    @property
+    def max_idx(self):
+        return len(self) - 1
+
+class CursorList(Cursor):
+    """Cursor over any sequence, without copying it."""
+
+    __slots__ = ("items", "idx")
+
+    def __init__(self, items):
+        self.items = items
+        self.idx = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        return self.items[i]
+
+class TokenLine(Cursor):
+    """Cursor over the words of one line of a flat token array."""
+
+    __slots__ = ("tokens", "vocab", "start", "end", "idx")
+
+    def __init__(self, tokens, vocab, start, end):
+        self.tokens = tokens
+        self.vocab = vocab
+        self.start = start
+        self.end = end
+        self.idx = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+
+        if not 0 <= i < len(self):
+            raise IndexError("word index out of range")
+
+        return self.vocab[self.tokens[self.start + i]]
+
+class TokenLines(Cursor):
+    """Cursor over the lines of a flat token array.
+
+    line_tokens holds the offset of each line's first token plus a final
+    end marker. The current line keeps its own word cursor until the line
+    cursor moves.
+    """
+
+    __slots__ = ("line_tokens", "tokens", "vocab", "idx", "line", "line_idx")
+
+    def __init__(self, line_tokens, tokens, vocab):
+        self.line_tokens = line_tokens
+        self.tokens = tokens
+        self.vocab = vocab
+        self.idx = 0
+        self.line = None
+        self.line_idx = None
+
+    def __len__(self):
+        return len(self.line_tokens) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+
+        if not 0 <= i < len(self):
+            raise IndexError("line index out of range")
+
+        return TokenLine(self.tokens, self.vocab, self.line_tokens[i], self.line_tokens[i + 1])
+
+    @property
+    def current(self):
+        if self.line_idx != self.idx:
+            self.line = self[self.idx]
+            self.line_idx = self.idx
+
+        return self.line
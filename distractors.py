@@ -0,0 +1,185 @@
+"""Wrong answers for GuessNext, drawn from indexes compiled into the corpus index."""
+
+import random
+from array import array
+from bisect import bisect_left
+
+class AliasTable:
+    """Walker/Vose alias table, samples an index proportional to its weight."""
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+
+        self.prob = array("d", [w * n / total for w in weights])
+        self.alias = array("I", range(n))
+
+        small = [i for i, p in enumerate(self.prob) if p < 1.0]
+        large = [i for i, p in enumerate(self.prob) if p >= 1.0]
+
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+
+            self.alias[less] = more
+            self.prob[more] += self.prob[less] - 1.0
+
+            if self.prob[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+
+        # Whatever is left is 1 up to rounding error
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self):
+        i = random.randrange(len(self.prob))
+        return i if random.random() < self.prob[i] else self.alias[i]
+
+class Distractors:
+    """Picks plausible wrong answers for a word.
+
+    Each draw chooses a strategy by weight, then a candidate from that
+    strategy's index:
+
+        frequency  any word, weighted by how often it occurs
+        initial    a word with the same first letter as the answer
+        length     a word of about the same length as the answer
+        bigram     a word that follows the previous word somewhere else
+
+    The indexes are sections of the corpus index, compiled with it and read
+    in place, so nothing is built when a game starts. Words are compared
+    lowercased.
+
+    Strategies can be added or reweighted by passing mix, a dict of
+    name to weight where name is a method called strategy_<name>.
+    """
+
+    MIX = {"frequency": 1, "initial": 2, "length": 2, "bigram": 3}
+
+    ATTEMPTS = 8
+
+    def __init__(self, index, mix=None):
+        self.index = index
+        self.count = index.folded_count
+
+        self.tokens = index.array("tokens")
+        self.folds = index.array("folds")
+        self.follower_offsets = index.array("follower_offsets")
+        self.followers = index.array("followers")
+        self.length_offsets = index.array("length_offsets")
+        self.by_length = index.array("by_length")
+        self.letters = index.array("letters")
+        self.letter_offsets = index.array("letter_offsets")
+
+        mix = mix or self.MIX
+        self.strategies = [getattr(self, "strategy_" + name) for name in mix]
+        self.mix = AliasTable(list(mix.values()))
+
+    def word(self, word_id):
+        return self.index.string("folded", "folded_offsets", word_id)
+
+    def find(self, word):
+        """Folded id of a lowercased word, or None if the corpus lacks it."""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.word(mid) < word:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo if lo < self.count and self.word(lo) == word else None
+
+    def pick(self, answer, previous=None, count=1):
+        """Return count distinct words that are not the answer."""
+        exclude = set([answer.lower()]) if answer else set()
+        picked = []
+
+        for _ in range(count):
+            word = None
+            for _ in range(self.ATTEMPTS):
+                strategy = self.strategies[self.mix.sample()]
+                word = strategy(answer, previous)
+                if word is not None and word not in exclude:
+                    break
+
+                word = None
+
+            if word is None:
+                word = self.fallback(exclude)
+                if word is None:
+                    break
+
+            exclude.add(word)
+            picked.append(match_case(word, answer))
+
+        return picked
+
+    def fallback(self, exclude):
+        for _ in range(self.ATTEMPTS):
+            word = self.strategy_frequency()
+            if word not in exclude:
+                return word
+
+        # Tiny vocabulary, look for anything left
+        for word_id in range(self.count):
+            word = self.word(word_id)
+            if word not in exclude:
+                return word
+
+        return None
+
+    def strategy_frequency(self, answer=None, previous=None):
+        # Every token is equally likely, so every word as often as it occurs
+        if not self.tokens:
+            return None
+
+        return self.word(self.folds[self.tokens[random.randrange(len(self.tokens))]])
+
+    def strategy_initial(self, answer, previous=None):
+        if not answer:
+            return None
+
+        letter = ord(answer.lower()[0])
+        i = bisect_left(self.letters, letter)
+        if i == len(self.letters) or self.letters[i] != letter:
+            return None
+
+        return self.word(random.randrange(self.letter_offsets[i], self.letter_offsets[i + 1]))
+
+    def strategy_length(self, answer, previous=None):
+        if not answer:
+            return None
+
+        length = len(answer) + random.randint(-1, 1)
+        if not 0 < length < len(self.length_offsets) - 1:
+            return None
+
+        return self.pick_from(self.by_length, self.length_offsets, length)
+
+    def strategy_bigram(self, answer, previous):
+        if not previous:
+            return None
+
+        word_id = self.find(previous.lower())
+        if word_id is None:
+            return None
+
+        return self.pick_from(self.followers, self.follower_offsets, word_id)
+
+    def pick_from(self, ids, offsets, i):
+        """A random word from the i-th run of ids, or None if it is empty."""
+        start, end = offsets[i], offsets[i + 1]
+        return self.word(ids[random.randrange(start, end)]) if start < end else None
+
+def match_case(word, answer):
+    """Capitalize word like the answer, so case doesn't give the answer away."""
+    if answer and answer[0].isupper():
+        return word[0].upper() + word[1:]
+
+    return word
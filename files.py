@@ -0,0 +1,24 @@
+"""File helpers for the device's FAT volumes.
+
+Shared by corpus_index.py and the pygamer scripts (copy it to the device
+along with them).
+"""
+
+import os
+
+def replace_file(tmp, path):
+    """Move tmp over path, which may or may not exist.
+
+    Atomic where the platform has os.replace. CircuitPython's FAT driver
+    can't rename over an existing file, so there path is removed first.
+    """
+    if hasattr(os, "replace"):
+        os.replace(tmp, path)
+        return
+
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+    os.rename(tmp, path)
@@ -7,14 +7,22 @@ import sys
 import glob
 import os
 import random
+from collections import namedtuple, OrderedDict
 
 # UI
 import pygame
 from pygame.locals import *
 
+import corpus_index
+from cursor import TokenLines
+from distractors import Distractors
+from review import ReviewQueue
+from metrics import Metrics
+
 pygame.init()
 
 font = pygame.font.SysFont(None, 48)
+small_font = pygame.font.SysFont(None, 18)
 background = pygame.Surface((800, 600))
 background.fill(pygame.Color('#000000'))
 
@@ -26,9 +34,22 @@ GREEN = (0, 255, 0)
 BLUE = (0, 0, 255)
 GRAY = (200, 200, 200)
 PINK = (255,20,147)
+ORANGE = (255, 165, 0)
+CYAN = (0, 255, 255)
+WHITE = (255, 255, 255)
+
+OPTION_COLORS = [GREEN, BLUE, ORANGE, CYAN, WHITE]
+
+# Grades to collect before writing the review state out
+SAVE_EVERY = 20
+
+# Wakes the idle loop to refresh the metrics overlay and dump
+METRICS_EVENT = pygame.USEREVENT
+METRICS_MS = 1000
 
 def main():
     path = sys.argv[1]
+    option_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2
 
     clock = pygame.time.Clock()
 
@@ -36,13 +57,43 @@ def main():
 
     is_running = True
 
-    lines = load_file(path)
-    game = Game(lines)
+    index = load_file(path)
+    game = Game(index, option_count, ReviewQueue.load(path + ".review", index.source_crc))
     state = Menu(game)
+    scene = Scene(screen, background)
+
+    metrics = Metrics.from_env()
+    metrics.gauge("text_cache.hit_rate", lambda: text_cache.hit_rate)
+    metrics.gauge("text_cache.size", lambda: len(text_cache.surfaces))
+    metrics.gauge("layout_cache.size", lambda: len(layout_cache))
+    show_metrics = False
+
+    if metrics.path is not None:
+        pygame.time.set_timer(METRICS_EVENT, METRICS_MS)
 
     play_idx = 0
+    frame_start = time.perf_counter()
     while is_running:
-        for event in pygame.event.get():
+        state = state.next_state
+
+        view = state.view()
+        if show_metrics:
+            view.update(metrics_view(metrics))
+
+        # Only push what changed, and nothing at all when idle
+        dirty = scene.render(view)
+        if dirty:
+            pygame.display.update(dirty)
+
+        metrics.time("frame." + state.__class__.__name__, time.perf_counter() - frame_start)
+        metrics.tick()
+
+        clock.tick(30)
+
+        events = wait_events()
+        frame_start = time.perf_counter()
+
+        for event in events:
             if event.type == pygame.QUIT:
                 is_running = False
             elif event.type == pygame.KEYUP and event.key == K_q:
@@ -51,6 +102,8 @@ def main():
                 state.btn_a()
             elif event.type == pygame.KEYDOWN and event.key == K_2:
                 state.btn_b()
+            elif event.type == pygame.KEYDOWN and event.key in (K_3, K_4, K_5):
+                state.btn_option(event.key - K_1)
             elif event.type == pygame.KEYDOWN and event.key == K_UP:
                 state.btn_up()
             elif event.type == pygame.KEYDOWN and event.key == K_DOWN:
@@ -59,20 +112,47 @@ def main():
                 state.btn_left()
             elif event.type == pygame.KEYDOWN and event.key == K_RIGHT:
                 state.btn_right()
+            elif event.type == pygame.KEYDOWN and event.key == K_d:
+                state.btn_due()
+            elif event.type == pygame.KEYDOWN and event.key == K_F3:
+                show_metrics = not show_metrics
+                if show_metrics or metrics.path is not None:
+                    pygame.time.set_timer(METRICS_EVENT, METRICS_MS)
+                else:
+                    pygame.time.set_timer(METRICS_EVENT, 0)
+            elif event.type == pygame.VIDEOEXPOSE:
+                scene.invalidate()
 
-        state = state.next_state
-        state.tick()
+    game.review.save()
+    metrics.dump()
 
-        pygame.display.update()
-        clock.tick(30)
+def metrics_view(metrics):
+    view = {}
+    for i, line in enumerate(metrics.summary()):
+        view["metrics_" + str(i)] = Text(line, WHITE, (480, 20 + 16 * i), small_font)
+
+    return view
+
+def wait_events():
+    """Block until there is at least one event, then drain the queue."""
+    return [pygame.event.wait()] + pygame.event.get()
 
 
 class Game:
 
-    def __init__(self, lines):
+    def __init__(self, index, option_count=2, review=None):
         self.points = 0
-        self.lines = lines
-        self.word_pool = list(set([word.lower() for line in lines for word in line]))
+        self.lines = TokenLines(index.array("line_tokens"), index.array("tokens"), index.vocab)
+        self.distractors = Distractors(index)
+        self.option_count = max(2, min(option_count, len(OPTION_COLORS)))
+        self.review = review if review is not None else ReviewQueue()
+
+    def grade(self, line, word, quality):
+        """Record recall of a word (or the whole line when word is -1), 0-5."""
+        self.review.record(line, word, quality)
+
+        if self.review.unsaved >= SAVE_EVERY:
+            self.review.save()
 
 class State:
 
@@ -86,6 +166,9 @@ class State:
     def btn_b(self):
         pass
 
+    def btn_option(self, n):
+        pass
+
     def btn_left(self):
         pass
 
@@ -100,17 +183,37 @@ class State:
         self.next_line()
         self.refresh()
 
+    def btn_due(self):
+        key = self.game.review.next_due()
+        if key is None:
+            return
+
+        self.leave_line()
+        self.lines.goto(key[0])
+        self.current_line.goto(0)
+        self.refresh()
+
     def next_line(self):
+        self.leave_line()
         self.lines.next()
         self.current_line.goto(0)
 
     def back_line(self):
+        self.leave_line()
         self.lines.back()
         self.current_line.goto(0)
 
+    def leave_line(self):
+        """Called before the line cursor moves."""
+        pass
+
     def refresh(self):
         pass
 
+    def view(self):
+        """Return the drawables this state shows, keyed by name."""
+        return {}
+
     @property
     def lines(self):
         return self.game.lines
@@ -128,11 +231,9 @@ class Menu(State):
     def btn_right(self):
         self.next_state = GuessNext(self.game)
 
-    def tick(self):
-        screen.blit(background, (0, 0))
-
+    def view(self):
         text_rect = Rect((20, 20), (800, 800))
-        draw_text(screen, self.lines.current.join(), GRAY, text_rect, font)
+        return {"verse": TextBlock(self.lines.current.join(), GRAY, text_rect)}
 
 class Initialisms(State):
 
@@ -142,11 +243,9 @@ class Initialisms(State):
     def btn_right(self):
         self.next_state = Blank(self.game)
 
-    def tick(self):
-        screen.blit(background, (0, 0))
-
+    def view(self):
         text_rect = Rect((20, 20), (800, 800))
-        draw_text(screen, self.initials, RED, text_rect, font)
+        return {"verse": TextBlock(self.initials, RED, text_rect)}
 
     @property
     def initials(self):
@@ -168,37 +267,45 @@ class Blank(State):
     def btn_b(self):
         self.last_shown = 0
 
+    def leave_line(self):
+        # Only lines the user asked hints for are graded; fewer is better
+        if self.last_shown > 0:
+            quality = max(1, 5 - round(4 * self.last_shown / len(self.current_line)))
+            self.game.grade(self.lines.idx, -1, quality)
+
     def refresh(self):
         self.last_shown = 0
 
-    def tick(self):
-        screen.blit(background, (0, 0))
-
+    def view(self):
         initials = [word[0] for word in self.current_line]
         initials = initials[0:self.last_shown]
         initials = " ".join(initials)
 
         text_rect = Rect((20, 20), (800, 800))
-        draw_text(screen, initials, RED, text_rect, font)
+        return {"verse": TextBlock(initials, RED, text_rect)}
 
 class GuessNext(State):
 
     def __init__(self, game):
         super().__init__(game)
 
-        self.option_a = None
-        self.option_b = None
+        self.options = []
         self.winning = None
+        self.mistakes = 0
 
         self.current_line.goto(0)
         self.refresh()
 
 
     def btn_a(self):
-        self.guess(self.option_a)
+        self.btn_option(0)
 
     def btn_b(self):
-        self.guess(self.option_b)
+        self.btn_option(1)
+
+    def btn_option(self, n):
+        if n < len(self.options):
+            self.guess(self.options[n])
 
     def btn_left(self):
         if self.current_line.idx > 0:
@@ -210,96 +317,282 @@ class GuessNext(State):
         self.next_state = Initialisms(self.game)
 
     def refresh(self):
-        options = [random.choice(self.game.word_pool), self.current_line.peek_next]
+        answer = self.current_line.peek_next
+        if answer is None:
+            # Finished the line, nothing left to guess
+            self.options = []
+            self.choice = None
+            return
+
+        options = self.game.distractors.pick(answer, self.current_word,
+                self.game.option_count - 1)
+        options.append(answer)
         random.shuffle(options)
-        self.option_a, self.option_b = options
+        self.options = options
         self.choice = None
 
+    def leave_line(self):
+        self.mistakes = 0
+
     def guess(self, choice):
+        if self.current_line.peek_next is None:
+            return
+
+        line = self.lines.idx
+        word = self.current_line.idx + 1
+
         if choice == self.current_line.peek_next:
             if self.winning:
                 self.game.points += 10
+            self.game.grade(line, word, 5 if self.winning else 4)
             self.current_line.next()
             self.winning = True
+
+            if self.current_line.peek_next is None:
+                self.game.grade(line, -1, max(0, 5 - self.mistakes))
+                self.mistakes = 0
         else:
+            self.game.grade(line, word, 1)
+            self.mistakes += 1
             self.winning = False
 
         self.refresh()
 
-    def tick(self):
-        screen.blit(background, (0, 0))
+    def view(self):
+        view = {}
 
         if self.current_line.peek_next is None:
-            render_text("Finished!", GRAY, (20, 20))
+            view["word"] = Text("Finished!", GRAY, (20, 20))
         else:
-            render_text(self.current_word, RED, (20, 20))
-            render_text(self.option_a, GREEN, (20, 80))
-            render_text(self.option_b, BLUE, (20, 120))
+            view["word"] = Text(self.current_word, RED, (20, 20))
+            for i, option in enumerate(self.options):
+                view["option_" + str(i)] = Text(option, OPTION_COLORS[i], (20, 80 + 40 * i))
 
-        status_pos = [20, 300]
-        status_pos[0] += render_text(str(self.game.points), PINK, (status_pos)).get_width()
+        score = str(self.game.points)
+        view["score"] = Text(score, PINK, (20, 300))
         if self.winning is not None:
-            status_pos[0] += 20
-            render_text(":-)" if self.winning else ":-(", PINK, status_pos)
+            status_x = 20 + font_metrics(font).word_width(score) + 20
+            view["mood"] = Text(":-)" if self.winning else ":-(", PINK, (status_x, 300))
 
-def render_text(text, color, pos):
-    surface = font.render(text, True, color)
-    screen.blit(surface, pos)
+        return view
 
-    return surface
+class Text(namedtuple("Text", ["text", "color", "pos", "font"], defaults=[None])):
 
-def load_file(path):
-    lines = []
-    with open(path) as f:
-        lines = f.readlines()
+    def draw(self, surface):
+        image = render_text(self.text, self.color, self.pos, surface, self.font)
+        return Rect(self.pos, image.get_size())
 
-    lines = [l.strip() for l in lines]
-    lines = [CursorList(l.split()) for l in lines if len(l) > 0]
+class TextBlock(namedtuple("TextBlock", ["text", "color", "rect"])):
 
-    return CursorList(lines)
+    def draw(self, surface):
+        draw_text(surface, self.text, self.color, self.rect, font)
+        return self.rect.clip(surface.get_rect())
 
-class CursorList(list):
+class Scene:
+    """Retained set of drawables that only redraws what changed.
 
-    def __init__(self, els):
-        self.idx = 0
-        super().__init__(els)
+    render() diffs the view against what is already on the surface, erases
+    stale items with the background and returns the dirty rectangles.
+    """
 
-    def join(self, s=" "):
-        return s.join(self)
+    def __init__(self, surface, background):
+        self.surface = surface
+        self.background = background
+        self.items = None
 
-    def goto(self, pos):
-        if pos < 0:
-            self.idx = max(0, self.max_idx + pos)
-        else:
-            self.idx = min(self.max_idx, pos)
+    def invalidate(self):
+        self.items = None
 
-        self.word_idx = 0
+    def render(self, view):
+        dirty = []
 
-    def next(self, count=1):
-        self.idx = min(self.max_idx, self.idx + count)
-        self.word_idx = 0
+        if self.items is None:
+            self.surface.blit(self.background, (0, 0))
+            self.items = {}
+            dirty.append(self.surface.get_rect())
 
-    def back(self, count=1):
-        self.idx = max(0, self.idx - count)
-        self.word_idx = 0
+        stale = [name for name, (item, rect) in self.items.items() if view.get(name) != item]
 
-    @property
-    def peek_next(self):
-        if self.idx == self.max_idx:
-            return None
+        # Erasing one item can clobber an unchanged neighbour, which then
+        # has to be redrawn as well
+        erased = [self.items[name][1] for name in stale]
+        while True:
+            clobbered = [name for name, (item, rect) in self.items.items()
+                    if name not in stale and rect.collidelist(erased) != -1]
+            if not clobbered:
+                break
 
-        return self[self.idx + 1]
+            stale += clobbered
+            erased += [self.items[name][1] for name in clobbered]
 
-    @property
-    def current(self):
-        return self[self.idx]
+        for rect in erased:
+            self.surface.blit(self.background, rect, rect)
+        dirty += erased
+
+        for name in stale:
+            del self.items[name]
+
+        for name, item in view.items():
+            if name in self.items:
+                continue
+
+            rect = item.draw(self.surface)
+            self.items[name] = (item, rect)
+            dirty.append(rect)
+
+        return dirty
+
+class SurfaceCache:
+    """Bounded LRU cache of rendered text surfaces."""
+
+    def __init__(self, size=256):
+        self.size = size
+        self.surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, font, text, antialias, color, bkg=None):
+        key = (text, tuple(color), font, antialias, bkg and tuple(bkg))
+
+        image = self.surfaces.get(key)
+        if image is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return image
+
+        self.misses += 1
+
+        if bkg:
+            image = font.render(text, antialias, color, bkg)
+            image.set_colorkey(bkg)
+        else:
+            image = font.render(text, antialias, color)
+
+        self.surfaces[key] = image
+        if len(self.surfaces) > self.size:
+            self.surfaces.popitem(last=False)
+
+        return image
 
     @property
-    def max_idx(self):
-        return len(self) - 1
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+text_cache = SurfaceCache()
+
+def render_text(text, color, pos, surface=screen, text_font=None):
+    image = text_cache.render(text_font or font, text, True, color)
+    surface.blit(image, pos)
+
+    return image
+
+def load_file(path):
+    """Open the corpus index for path, compiling it first if it is stale."""
+    return corpus_index.load(path)
+
+class FontMetrics:
+    """Caches glyph and word advance widths for a single font."""
+
+    def __init__(self, font):
+        self.font = font
+        self.height = font.size("Tg")[1]
+        self.glyphs = {}
+        self.words = {}
+        self.space = self.glyph_width(" ")
+
+    def glyph_width(self, glyph):
+        width = self.glyphs.get(glyph)
+        if width is None:
+            width = self.glyphs[glyph] = self.font.size(glyph)[0]
+
+        return width
+
+    def word_width(self, word):
+        width = self.words.get(word)
+        if width is None:
+            width = self.words[word] = self.font.size(word)[0]
+
+        return width
+
+    def split_word(self, word, max_width):
+        """Break a word that is wider than max_width into pieces that fit."""
+        pieces = []
+        start = 0
+        width = 0
+        for i, glyph in enumerate(word):
+            advance = self.glyph_width(glyph)
+            if width + advance >= max_width and i > start:
+                pieces.append(word[start:i])
+                start = i
+                width = 0
+
+            width += advance
+
+        pieces.append(word[start:])
+
+        return pieces
 
+font_metrics_cache = {}
+
+def font_metrics(font):
+    metrics = font_metrics_cache.get(font)
+    if metrics is None:
+        metrics = font_metrics_cache[font] = FontMetrics(font)
+
+    return metrics
+
+LAYOUT_CACHE_SIZE = 512
+layout_cache = {}
+
+def layout_text(text, max_width, font):
+    """Wrap text by word into lines narrower than max_width.
+
+    Runs in a single pass over the words and memoizes the result, so laying
+    out an unchanged verse again is a dictionary lookup.
+    """
+    key = (text, max_width, font)
+    lines = layout_cache.get(key)
+    if lines is not None:
+        return lines
+
+    metrics = font_metrics(font)
+
+    lines = []
+    line = []
+    width = 0
+    for word in text.split():
+        word_width = metrics.word_width(word)
+
+        if line and width + metrics.space + word_width < max_width:
+            line.append(word)
+            width += metrics.space + word_width
+            continue
+
+        if line:
+            lines.append(" ".join(line))
+
+        if word_width < max_width:
+            line = [word]
+            width = word_width
+            continue
+
+        # Word doesn't fit on a line of its own, break it up
+        pieces = metrics.split_word(word, max_width)
+        lines.extend(pieces[:-1])
+        line = [pieces[-1]]
+        width = metrics.word_width(pieces[-1])
+
+    if line:
+        lines.append(" ".join(line))
+
+    if len(layout_cache) >= LAYOUT_CACHE_SIZE:
+        layout_cache.clear()
+
+    lines = layout_cache[key] = tuple(lines)
+
+    return lines
 
-# copy and pasted from https://www.pygame.org/wiki/TextWrap
 # draw some text into an area of a surface
 # automatically wraps words
 # returns any text that didn't get blitted
@@ -309,37 +602,20 @@ def draw_text(surface, text, color, rect, font, aa=False, bkg=None):
     lineSpacing = -2
 
     # get the height of the font
-    fontHeight = font.size("Tg")[1]
-
-    while text:
-        i = 1
+    fontHeight = font_metrics(font).height
 
+    lines = layout_text(text, rect.width, font)
+    for i, line in enumerate(lines):
         # determine if the row of text will be outside our area
         if y + fontHeight > rect.bottom:
-            break
-
-        # determine maximum width of line
-        while font.size(text[:i])[0] < rect.width and i < len(text):
-            i += 1
-
-        # if we've wrapped the text, then adjust the wrap to the last word
-        if i < len(text):
-            i = text.rfind(" ", 0, i) + 1
+            return " ".join(lines[i:])
 
         # render the line and blit it to the surface
-        if bkg:
-            image = font.render(text[:i], 1, color, bkg)
-            image.set_colorkey(bkg)
-        else:
-            image = font.render(text[:i], aa, color)
-
+        image = text_cache.render(font, line, True if bkg else aa, color, bkg)
         surface.blit(image, (rect.left, y))
         y += fontHeight + lineSpacing
 
-        # remove the text we just blitted
-        text = text[i:]
-
-    return text
+    return ""
 
 if __name__ == "__main__":
     main()
@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 
 # Core
+import bisect
+import concurrent.futures
+import multiprocessing
 import queue
 import time
 import sys
-import glob
 import os
+import json
+import threading
+from collections import OrderedDict
 
 # Community - Audio
+import numpy as np
 import sounddevice as sd
 import soundfile as sf
 
@@ -15,13 +21,68 @@ import soundfile as sf
 import pygame
 from pygame.locals import *
 
+from archive import FORMATS, Archiver
+from compare import compare
+from metrics import Metrics
+from peaks import PeakBuilder, Peaks, peaks_path
+from vad import Segmenter
+
 CHANNELS = 1
 SAMPLE_RATE = 44100
 
+# Seconds of audio the recorder can hold before the writer falls behind
+RING_SECONDS = 10
+
+# Seconds of audio decoded ahead of playback
+READ_AHEAD_SECONDS = 0.5
+READ_BLOCK_FRAMES = 4096
+
+SKIP_SECONDS = 5
+
+# Bytes of decoded audio kept around for quick replay
+CACHE_BYTES = 256 * 1024 * 1024
+
+AUDIO_EXTENSIONS = (".wav", ".flac", ".ogg", ".opus")
+
+# Takes are kept as recorded unless ARCHIVE_FORMAT is set in the environment
+# to "flac", "vorbis" or "opus", which compresses them in the background (see
+# archive.py), including every WAV already in the directory
+
+# Takes are recorded whole unless TRIM_SILENCE is set in the environment:
+# "trim" drops the silence around speech, "split" also starts a new segment
+# after each long pause. Trimmed audio can't be recovered.
+TRIM_MODES = ("trim", "split")
+
+# Manifest changes appended before it's rewritten in one piece at startup
+COMPACT_LINES = 1000
+
+# Milliseconds between checks of the recordings directory for outside changes
+REFRESH_MS = 2000
+REFRESH_EVENT = pygame.USEREVENT
+
+WAVEFORM_RECT = pygame.Rect(20, 440, 760, 140)
+ZOOM_STEP = 2
+MAX_ZOOM = 4096
+PAN_STEP = 0.25
+
+# Lines of the last comparison against the reference take shown
+REPORT_LINES = 7
+REPORT_POS = (20, 300)
+
 def main():
     base = sys.argv[1]
 
-    rec = Recorder()
+    metrics = Metrics.from_env()
+
+    trim = os.environ.get("TRIM_SILENCE")
+    if trim is not None and trim not in TRIM_MODES:
+        sys.exit("TRIM_SILENCE must be one of: " + ", ".join(TRIM_MODES))
+
+    rec = Recorder(metrics, trim is not None, trim == "split")
+
+    archive_format = os.environ.get("ARCHIVE_FORMAT")
+    if archive_format is not None and archive_format not in FORMATS:
+        sys.exit("ARCHIVE_FORMAT must be one of: " + ", ".join(FORMATS))
 
     pygame.init()
 
@@ -33,23 +94,69 @@ def main():
     background = pygame.Surface((800, 600))
     background.fill(pygame.Color('#000000'))
 
+    font = pygame.font.SysFont(None, 18)
+    show_metrics = False
+
     is_running = True
 
-    file_manager = FileManager(base)
+    file_manager = FileManager(base, AudioCache())
+    player = Player(file_manager.cache, metrics)
+    waveform = Waveform(WAVEFORM_RECT)
+    comparer = Comparer()
+
+    archiver = Archiver(archive_format) if archive_format else None
+    if archiver is not None:
+        metrics.gauge("archive.pending", lambda: len(archiver.pending))
+        metrics.gauge("archive.failed", lambda: archiver.failed)
+
+        # Takes from before archiving was turned on
+        for path in file_manager.select(lambda take: True):
+            archiver.submit(path)
+
+    pygame.time.set_timer(REFRESH_EVENT, REFRESH_MS)
 
     play_idx = 0
+    frame_start = time.perf_counter()
     while is_running:
+        while not rec.finished.empty():
+            path = rec.finished.get()
+            file_manager.update(path)
+
+            if archiver is not None and os.path.exists(path):
+                archiver.submit(path)
+
+            reference = file_manager.reference
+            if reference is not None and os.path.exists(path) and path != reference:
+                comparer.submit(path, reference)
+
+        comparer.poll()
+
+        if archiver is not None:
+            finished = archiver.done()
+            if finished:
+                file_manager.replace(finished)
+
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 is_running = False
+            elif event.type == REFRESH_EVENT:
+                file_manager.refresh()
             elif event.type == pygame.KEYUP and event.key == K_q:
                 is_running = False
             elif event.type == pygame.KEYDOWN and event.key == K_r:
                 rec.start(file_manager.new_file())
             elif event.type == pygame.KEYUP and event.key == K_r:
                 rec.stop()
-            elif event.type == pygame.KEYDOWN and event.key == K_p:
-                play_audio(file_manager.current)
+            elif event.type == pygame.KEYDOWN and event.key == K_p and file_manager.paths:
+                # Nothing to play until a take is written
+                if file_manager.take(file_manager.current) is not None:
+                    player.play(file_manager.current)
+            elif event.type == pygame.KEYDOWN and event.key == K_SPACE:
+                player.toggle_pause()
+            elif event.type == pygame.KEYDOWN and event.key == K_LEFT:
+                player.skip(-SKIP_SECONDS)
+            elif event.type == pygame.KEYDOWN and event.key == K_RIGHT:
+                player.skip(SKIP_SECONDS)
             elif event.type == pygame.KEYDOWN and event.key == K_n:
                 file_manager.next()
             elif event.type == pygame.KEYDOWN and event.key == K_b:
@@ -58,88 +165,1026 @@ def main():
                 file_manager.seek(0)
             elif event.type == pygame.KEYDOWN and event.key == K_e:
                 file_manager.seek(-1)
+            elif event.type == pygame.KEYDOWN and event.key == K_EQUALS:
+                waveform.zoom_by(ZOOM_STEP)
+            elif event.type == pygame.KEYDOWN and event.key == K_MINUS:
+                waveform.zoom_by(1 / ZOOM_STEP)
+            elif event.type == pygame.KEYDOWN and event.key == K_LEFTBRACKET:
+                waveform.pan(-PAN_STEP)
+            elif event.type == pygame.KEYDOWN and event.key == K_RIGHTBRACKET:
+                waveform.pan(PAN_STEP)
+            elif event.type == pygame.KEYDOWN and event.key == K_m and file_manager.paths:
+                file_manager.mark_reference()
+            elif event.type == pygame.KEYDOWN and event.key == K_c and file_manager.paths:
+                reference = file_manager.reference
+                if reference is not None and reference != file_manager.current:
+                    comparer.submit(file_manager.current, reference)
+            elif event.type == pygame.KEYDOWN and event.key == K_F3:
+                show_metrics = not show_metrics
 
         window_surface.blit(background, (0, 0))
 
+        # Takes still being written have no peaks yet
+        if file_manager.paths and file_manager.take(file_manager.current) is not None:
+            path = file_manager.current
+            take = file_manager.take(path)
+
+            label = "{} ({}/{}) {:.1f}s".format(os.path.basename(path),
+                    file_manager.idx + 1, len(file_manager.paths), take["duration"])
+            if path == file_manager.reference:
+                label += " reference"
+            window_surface.blit(font.render(label, True, (255, 255, 255)),
+                    (WAVEFORM_RECT.left, WAVEFORM_RECT.top - 20))
+
+            waveform.show(path)
+            waveform.draw(window_surface, player.position(path))
+
+        for i, line in enumerate(comparer.lines[:REPORT_LINES]):
+            window_surface.blit(font.render(line, True, (255, 255, 255)),
+                    (REPORT_POS[0], REPORT_POS[1] + 16 * i))
+
+        if show_metrics:
+            for i, line in enumerate(metrics.summary()):
+                window_surface.blit(font.render(line, True, (255, 255, 255)), (20, 20 + 16 * i))
+
         pygame.display.update()
+
+        metrics.time("frame.mem", time.perf_counter() - frame_start)
+        metrics.tick()
+
         clock.tick(30)
+        frame_start = time.perf_counter()
 
-def play_audio(path):
-    sd.stop()
-    data, fs = sf.read(path, dtype='float32')
-    sd.play(data, fs)
+    player.stop()
 
-class FileManager:
+    # Quitting with R still held
+    if rec.stream is not None:
+        rec.stop()
+    rec.wait()
+    if archiver is not None:
+        archiver.shutdown()
+    comparer.shutdown()
+    metrics.dump()
+
+class Manifest:
+    """Sidecar index of the takes in a recordings directory.
+
+    Stored as <base>.takes.jsonl next to the directory (so writing it doesn't
+    touch the directory's mtime). Holds frames, sample rate, channels, size
+    and mtime per take, and the counter new take names are allocated from.
+    The directory is only listed again when its mtime changes, and only new
+    takes are opened to read their headers.
+
+    Each change is appended as a line of just the fields it sets, with new
+    or updated takes under "takes" and dropped ones under "removed", so
+    reserving a name costs the same however many takes there are. Loading
+    replays the lines in order, and rewrites them as one line once there
+    are more than COMPACT_LINES or the last one was cut off.
+    """
 
     def __init__(self, base):
-        self.paths = sorted(glob.glob("{}/*.wav".format(base)))
+        self.base = base
+        self.path = os.path.normpath(base) + ".takes.jsonl"
+        self.takes = {}
+        self.next_id = 1
+        self.dir_mtime = None
+        self.reference = None
+        self.lines = 0
+        self.torn = False
+
+    @staticmethod
+    def load(base):
+        manifest = Manifest(base)
+
+        try:
+            with open(manifest.path, "r") as f:
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        change = None
+
+                    if change is None or not line.endswith("\n"):
+                        # Appending after it would garble the next line too
+                        manifest.torn = True
+                        continue
+
+                    manifest.apply(change)
+                    manifest.lines += 1
+        except OSError:
+            return manifest
+
+        if manifest.torn or manifest.lines > COMPACT_LINES:
+            manifest.compact()
+
+        return manifest
+
+    def apply(self, change):
+        self.takes.update(change.get("takes", {}))
+        for name in change.get("removed", []):
+            self.takes.pop(name, None)
+
+        for field in ("next_id", "dir_mtime", "reference"):
+            if field in change:
+                setattr(self, field, change[field])
+
+    def log(self, change):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(change) + "\n")
+
+        self.lines += 1
+
+    def compact(self):
+        state = {"next_id": self.next_id, "dir_mtime": self.dir_mtime,
+                "reference": self.reference, "takes": self.takes}
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps(state) + "\n")
+
+        os.replace(tmp, self.path)
+        self.lines = 1
+        self.torn = False
+
+    def refresh(self):
+        """Pick up takes added or removed by other tools; return whether any were."""
+        dir_mtime = os.stat(self.base).st_mtime_ns
+        if dir_mtime == self.dir_mtime:
+            return False
+
+        names = set(entry.name for entry in os.scandir(self.base)
+                if entry.name.lower().endswith(AUDIO_EXTENSIONS))
+
+        removed = sorted(set(self.takes) - names)
+        for name in removed:
+            del self.takes[name]
+
+        probed = {}
+        for name in names:
+            if self.takes.get(name) is None:
+                self.takes[name] = probed[name] = self.probe(name)
+
+            # Never hand out a number another take already has
+            stem = os.path.splitext(name)[0]
+            if stem.isdigit():
+                self.next_id = max(self.next_id, int(stem) + 1)
+
+        self.dir_mtime = dir_mtime
+        self.log({"removed": removed, "takes": probed, "next_id": self.next_id,
+                "dir_mtime": dir_mtime})
+
+        return True
+
+    def probe(self, name):
+        path = os.path.join(self.base, name)
+
+        try:
+            st = os.stat(path)
+            info = sf.info(path)
+        except (OSError, RuntimeError):
+            # Gone already, or still being written
+            return None
+
+        return {
+            "frames": info.frames,
+            "samplerate": info.samplerate,
+            "channels": info.channels,
+            "duration": info.duration,
+            "size": st.st_size,
+            "mtime": st.st_mtime_ns,
+        }
+
+    def allocate(self, ext=".wav"):
+        """Reserve a name for a new take."""
+        while True:
+            name = str(self.next_id).zfill(5) + ext
+            self.next_id += 1
+
+            if name not in self.takes and not os.path.exists(os.path.join(self.base, name)):
+                self.takes[name] = None
+                self.log({"next_id": self.next_id, "takes": {name: None}})
+
+                return name
+
+    def update(self, name):
+        self.takes[name] = self.probe(name)
+        self.log({"takes": {name: self.takes[name]}})
+
+    def remove(self, name):
+        change = {"removed": [name]}
+
+        self.takes.pop(name, None)
+        if name == self.reference:
+            self.reference = change["reference"] = None
+
+        self.log(change)
+
+    def swap(self, renames):
+        """Replace takes with others, such as compressed copies, in one change."""
+        change = {"removed": [], "takes": {}}
+
+        for old, new in renames:
+            self.takes.pop(old, None)
+            change["removed"].append(old)
+
+            self.takes[new] = change["takes"][new] = self.probe(new)
+            if old == self.reference:
+                self.reference = change["reference"] = new
+
+        self.log(change)
+
+    def set_reference(self, name):
+        self.reference = name
+        self.log({"reference": name})
+
+class FileManager:
+
+    def __init__(self, base, cache=None):
         self.base = base
         self.idx = 0
+        self.cache = cache
+
+        self.manifest = Manifest.load(base)
+        self.manifest.refresh()
+        self.paths = self.list_paths()
+
+        self.prefetch()
+
+    def list_paths(self):
+        return [os.path.join(self.base, name) for name in sorted(self.manifest.takes)]
+
+    def refresh(self):
+        if self.manifest.refresh():
+            self.relist()
+
+    def relist(self):
+        """List the takes again, staying on the current one if it's still there."""
+        current = self.current if self.paths else None
+        self.paths = self.list_paths()
+
+        if current in self.paths:
+            self.idx = self.paths.index(current)
+        else:
+            self.idx = max(0, min(self.idx, self.max_idx))
 
     def new_file(self):
-        path = "{}/{}.wav".format(self.base, str(len(self.paths) + 1).zfill(5))
+        path = os.path.join(self.base, self.manifest.allocate())
         self.paths.append(path)
 
         return path
 
+    def update(self, path):
+        """Record the header of a take that has finished being written.
+
+        The take may be an extra segment split off by the recorder, or may
+        not exist at all if nothing but silence was recorded.
+        """
+        name = os.path.basename(path)
+        if os.path.exists(path):
+            self.manifest.update(name)
+        else:
+            self.manifest.remove(name)
+
+        self.relist()
+
+    def replace(self, pairs):
+        """Swap takes for re-encoded copies of them, keeping their peaks.
+
+        pairs holds (take, copy) paths. The manifest gets one change for all
+        of them, and the list is only sorted again if a copy's name doesn't
+        sort where the take's did.
+        """
+        swapped = []
+        for path, new_path in pairs:
+            try:
+                os.remove(path)
+            except OSError:
+                # Still open somewhere; keep the original and try another time
+                os.remove(new_path)
+                continue
+
+            try:
+                os.replace(peaks_path(path), peaks_path(new_path))
+            except OSError:
+                pass
+
+            swapped.append((path, new_path))
+
+        if not swapped:
+            return
+
+        self.manifest.swap([(os.path.basename(path), os.path.basename(new_path))
+                for path, new_path in swapped])
+
+        in_order = True
+        for path, new_path in swapped:
+            i = bisect.bisect_left(self.paths, path)
+            if i == len(self.paths) or self.paths[i] != path:
+                in_order = False
+                continue
+
+            self.paths[i] = new_path
+            if (i > 0 and self.paths[i - 1] > new_path) or (i < self.max_idx and self.paths[i + 1] < new_path):
+                in_order = False
+
+        if not in_order:
+            renamed = dict(swapped)
+            if self.paths and self.current in renamed:
+                self.paths[self.idx] = renamed[self.current]
+
+            self.relist()
+
+    @property
+    def reference(self):
+        """Path of the take others are compared against, or None."""
+        if self.manifest.reference is None:
+            return None
+
+        return os.path.join(self.base, self.manifest.reference)
+
+    def mark_reference(self):
+        self.manifest.set_reference(os.path.basename(self.current))
+
+    def take(self, path):
+        """Manifest entry for path, or None if not known yet."""
+        return self.manifest.takes.get(os.path.basename(path))
+
+    def select(self, predicate):
+        """Paths of the takes whose manifest entry satisfies predicate."""
+        return [path for path in self.paths
+                if self.take(path) is not None and predicate(self.take(path))]
+
     def seek(self, pos):
         if pos < 0:
             self.idx = max(0, self.max_idx + pos)
         else:
             self.idx = min(self.max_idx, pos)
 
+        self.prefetch()
+
     def next(self, count=1):
         self.idx = min(self.max_idx, self.idx + count)
+        self.prefetch()
 
     def back(self, count=1):
         self.idx = max(0, self.idx - count)
+        self.prefetch()
+
+    def prefetch(self):
+        """Have the cache decode the current take and its neighbours."""
+        if self.cache is None:
+            return
+
+        order = [self.idx, self.idx + 1, self.idx - 1]
+        self.cache.prefetch([self.paths[i] for i in order if 0 <= i <= self.max_idx])
 
     @property
     def current(self):
         return self.paths[self.idx]
 
     def remove_current(self):
-        os.remove(self.paths.pop())
+        path = self.paths.pop(self.idx)
+        os.remove(path)
+        self.manifest.remove(os.path.basename(path))
+
+        try:
+            os.remove(peaks_path(path))
+        except OSError:
+            pass
+
+        self.idx = max(0, min(self.idx, self.max_idx))
 
     @property
     def max_idx(self):
         return len(self.paths) - 1
 
-class Recorder:
+class RingBuffer:
+    """Single-producer, single-consumer ring of audio frames.
 
-    def __init__(self):
+    Only the audio callback advances written and only the writer thread
+    advances read, so neither side takes a lock.
+    """
+
+    def __init__(self, frames, channels):
+        self.data = np.zeros((frames, channels), dtype="float32")
+        self.written = 0
+        self.read = 0
+        self.dropped = 0
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    @property
+    def available(self):
+        return self.written - self.read
+
+    def put(self, block):
+        frames = len(block)
+        if self.available + frames > self.size:
+            self.dropped += frames
+            return False
+
+        start = self.written % self.size
+        first = min(frames, self.size - start)
+        self.data[start:start + first] = block[:first]
+        self.data[:frames - first] = block[first:]
+
+        self.written += frames
+        return True
+
+    def peek(self):
+        """Return the longest contiguous run of unread frames, without copying."""
+        start = self.read % self.size
+        return self.data[start:start + min(self.available, self.size - start)]
+
+    def advance(self, frames):
+        self.read += frames
+
+    def get(self, out):
+        """Copy as many unread frames as fit into out, return how many."""
+        frames = min(len(out), self.available)
+
+        start = self.read % self.size
+        first = min(frames, self.size - start)
+        out[:first] = self.data[start:start + first]
+        out[first:frames] = self.data[:frames - first]
+
+        self.read += frames
+        return frames
+
+    def clear(self):
+        """Drop unread frames; only safe while neither side is running."""
+        self.read = self.written
+
+class Writer(threading.Thread):
+    """Streams frames from a RingBuffer into a Take (or Segmenter) until finished."""
+
+    def __init__(self, ring, sink, interval=0.05):
+        super().__init__(daemon=True)
+
+        self.ring = ring
+        self.sink = sink
+        self.interval = interval
+        self.finished = False
+
+    def run(self):
+        while True:
+            # Check before reading so frames put just before finish() are kept
+            finished = self.finished
+
+            block = self.ring.peek()
+            if len(block):
+                self.sink.write(block)
+                self.ring.advance(len(block))
+            elif finished:
+                break
+            else:
+                time.sleep(self.interval)
+
+        self.sink.close()
+
+    def finish(self):
+        self.finished = True
+
+class Take:
+    """A take being recorded, with its peaks computed from the same blocks.
+
+    The file is only created once something is written to it. On close the
+    peaks are saved next to it and its path is put on finished, whether or
+    not it was created.
+    """
+
+    def __init__(self, path, finished=None):
+        self.path = path
+        self.on_finished = finished
         self.file = None
+        self.peaks = PeakBuilder(SAMPLE_RATE)
+
+    def write(self, block):
+        if self.file is None:
+            self.file = sf.SoundFile(self.path, mode='x', samplerate=SAMPLE_RATE,
+                    channels=CHANNELS, subtype="PCM_24")
+
+        self.file.write(block)
+        self.peaks.add(block)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.peaks.save(peaks_path(self.path))
+
+        if self.on_finished is not None:
+            self.on_finished.put(self.path)
+
+class SegmentOpener:
+    """Opens the segments of one take in turn, named after the take."""
+
+    def __init__(self, path, finished):
+        self.path = path
+        self.finished = finished
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+        return Take(segment_path(self.path, self.count), self.finished)
+
+def segment_path(path, n):
+    """Path of the nth segment of a take; sorts right after the take itself."""
+    if n == 1:
+        return path
+
+    stem, ext = os.path.splitext(path)
+    return "{}_{:03}{}".format(stem, n, ext)
+
+class LatestWorker:
+    """Daemon thread that runs fn on the latest request only.
+
+    A request made while another is still waiting replaces it, so a burst
+    of requests doesn't queue up work that is already out of date.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.requests = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def request(self, arg):
+        try:
+            self.requests.get_nowait()
+        except queue.Empty:
+            pass
+
+        try:
+            self.requests.put_nowait(arg)
+        except queue.Full:
+            pass
+
+    def work(self):
+        while True:
+            self.fn(self.requests.get())
+
+class AudioCache:
+    """Memory-budgeted LRU of decoded takes, keyed by path and mtime.
+
+    prefetch() decodes on a background thread; only the latest request is
+    kept, so stepping quickly through takes doesn't queue up work.
+    """
+
+    def __init__(self, budget=CACHE_BYTES):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.worker = LatestWorker(self.load_all)
+
+    def get(self, path):
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != mtime:
+                return None
+
+            self.entries.move_to_end(path)
+            return entry[1], entry[2]
+
+    def open(self, path):
+        """Return a file-like source for path, from memory when cached."""
+        cached = self.get(path)
+        if cached is None:
+            return sf.SoundFile(path)
+
+        return MemoryFile(*cached)
+
+    def load(self, path):
+        if self.get(path) is not None:
+            return
+
+        try:
+            mtime = os.path.getmtime(path)
+            info = sf.info(path)
+            if info.frames * info.channels * 4 > self.budget:
+                return
+
+            data, samplerate = sf.read(path, dtype="float32", always_2d=True)
+        except (OSError, RuntimeError):
+            # Missing, or still being written
+            return
+
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= old[1].nbytes
+
+            self.entries[path] = (mtime, data, samplerate)
+            self.size += data.nbytes
+
+            while self.size > self.budget:
+                _, (_, evicted, _) = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes
+
+    def load_all(self, paths):
+        for path in paths:
+            self.load(path)
+
+    def prefetch(self, paths):
+        self.worker.request(paths)
+
+class MemoryFile:
+    """Just enough of SoundFile to play a decoded buffer."""
+
+    def __init__(self, data, samplerate):
+        self.data = data
+        self.samplerate = samplerate
+        self.channels = data.shape[1]
+        self.frames = len(data)
+        self.pos = 0
+
+    def read(self, frames, dtype="float32", always_2d=True, out=None):
+        block = self.data[self.pos:self.pos + frames]
+        self.pos += len(block)
+
+        out[:len(block)] = block
+        return out[:len(block)]
+
+    def seek(self, frame):
+        self.pos = frame
+
+    def close(self):
+        pass
+
+class Player:
+
+    def __init__(self, cache=None, metrics=None):
+        self.playback = None
+        self.path = None
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else Metrics()
+
+    def play(self, path):
+        self.stop()
+
+        file = self.cache.open(path) if self.cache else sf.SoundFile(path)
+
+        self.playback = Playback(file, self.metrics)
+        self.playback.start()
+        self.path = path
+
+    def stop(self):
+        if self.playback is not None:
+            self.playback.close()
+            self.playback = None
+            self.path = None
+
+    def position(self, path):
+        """Frame being played if path is playing, else None."""
+        if self.playback is None or path != self.path:
+            return None
+
+        return self.playback.position
+
+    def toggle_pause(self):
+        if self.playback is None:
+            return
+
+        if self.playback.paused:
+            self.playback.resume()
+        else:
+            self.playback.pause()
+
+    def skip(self, seconds):
+        if self.playback is not None:
+            self.playback.seek(self.playback.position + int(seconds * self.playback.samplerate))
+
+class Playback:
+    """Streams one SoundFile (or MemoryFile) to the output device.
+
+    A decoder thread keeps a small ring buffer topped up from the SoundFile
+    and the stream callback plays from the ring, so playback starts after a
+    single block is decoded and memory use doesn't depend on the file.
+    """
+
+    def __init__(self, file, metrics):
+        self.file = file
+        self.metrics = metrics
+        self.samplerate = self.file.samplerate
+
+        self.ring = RingBuffer(int(self.samplerate * READ_AHEAD_SECONDS), self.file.channels)
+        self.block = np.empty((READ_BLOCK_FRAMES, self.file.channels), dtype="float32")
+
+        # Held by the decoder while it reads, and by seek() while it moves the file
+        self.lock = threading.Lock()
+
+        self.position = 0
+        self.eof = False
+        self.paused = False
+        self.closed = False
+
+        self.stream = sd.OutputStream(samplerate=self.samplerate,
+                channels=self.file.channels, dtype="float32", callback=self.callback)
+        self.decoder = threading.Thread(target=self.decode, daemon=True)
+
+    def start(self):
+        with self.lock:
+            self.fill()
+
+        self.decoder.start()
+        self.stream.start()
+
+    def pause(self):
+        self.paused = True
+        self.stream.stop()
+
+    def resume(self):
+        self.paused = False
+        self.stream.stop()
+        self.stream.start()
+
+    def seek(self, frame):
+        frame = max(0, min(frame, self.file.frames))
+
+        # stop() waits for the callback, after which nobody reads the ring
+        self.stream.stop()
+
+        with self.lock:
+            self.file.seek(frame)
+            self.ring.clear()
+            self.position = frame
+            self.eof = False
+            self.fill()
+
+        if not self.paused:
+            self.stream.start()
+
+    def close(self):
+        self.closed = True
+        self.stream.stop()
+        self.stream.close()
+        self.decoder.join()
+        self.file.close()
+
+    def decode(self):
+        while not self.closed:
+            with self.lock:
+                filled = self.fill()
+
+            if not filled:
+                time.sleep(READ_AHEAD_SECONDS / 4)
+
+    def fill(self):
+        """Decode one block into the ring if it has room."""
+        if self.eof or self.ring.size - self.ring.available < len(self.block):
+            return False
+
+        block = self.file.read(len(self.block), dtype="float32", always_2d=True, out=self.block)
+        if len(block) < len(self.block):
+            self.eof = True
+
+        self.ring.put(block)
+
+        return len(block) > 0
+
+    def callback(self, outdata, frames, time, status):
+        if status:
+            count_status(self.metrics, "playback", status)
+
+        played = self.ring.get(outdata)
+        outdata[played:] = 0
+        self.position += played
+
+        if played < frames and not self.eof:
+            self.metrics.count("playback.underruns")
+
+        if played == 0 and self.eof:
+            raise sd.CallbackStop
+
+class Recorder:
+    """Records takes from the input device.
+
+    With trim, silence before and after speech isn't written (see vad.py);
+    with split as well, every long pause starts a new segment, written next
+    to the take as <take>_002.wav and so on.
+    """
+
+    def __init__(self, metrics=None, trim=False, split=False):
+        self.path = None
         self.buffer = None
         self.stream = None
+        self.writer = None
+        self.segmenter = None
+
+        self.trim = trim
+        self.split = split
+
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.gauge("recorder.ring_frames", lambda: self.buffer.available if self.buffer else 0)
+        self.metrics.gauge("recorder.writer_lag_s", self.writer_lag)
+        self.metrics.gauge("recorder.dropped_frames", lambda: self.buffer.dropped if self.buffer else 0)
+        self.metrics.gauge("recorder.trimmed_s",
+                lambda: self.segmenter.trimmed / SAMPLE_RATE if self.segmenter else 0.0)
+
+        # Paths of takes that are completely written
+        self.finished = queue.Queue()
 
     def start(self, path):
-        self.file = sf.SoundFile(path, mode='x', samplerate=SAMPLE_RATE,
-                channels=CHANNELS, subtype="PCM_24")
+        self.path = path
+
+        self.buffer = RingBuffer(SAMPLE_RATE * RING_SECONDS, CHANNELS)
+
+        # The writer may still be draining this take after the next one has
+        # started, so it gets an opener of its own rather than reading ours
+        open_segment = SegmentOpener(path, self.finished)
+
+        # Detection runs on the writer thread, keeping the callback a copy
+        if self.trim:
+            self.segmenter = Segmenter(SAMPLE_RATE, CHANNELS, open_segment, self.split)
+            sink = self.segmenter
+        else:
+            self.segmenter = None
+            sink = open_segment()
 
-        self.buffer = queue.Queue()
+        self.writer = Writer(self.buffer, sink)
+        self.writer.start()
 
-        self.stream = sd.InputStream(samplerate=SAMPLE_RATE, channels=CHANNELS, callback=self.callback)
+        self.stream = sd.InputStream(samplerate=SAMPLE_RATE, channels=CHANNELS,
+                dtype="float32", callback=self.callback)
         self.stream.start()
 
     def stop(self):
-        if self.file is None:
-            raise "Attempted to stop a stopped recorder"
+        """Stop recording; the writer flushes the rest in the background."""
+        if self.stream is None:
+            raise RuntimeError("Attempted to stop a stopped recorder")
 
         self.stream.stop()
-
-        while not self.buffer.empty():
-            self.file.write(self.buffer.get())
+        self.stream.close()
+        self.writer.finish()
 
         self.stream = None
 
-        return self.file.name
+        return self.path
+
+    def wait(self):
+        """Block until the last take is completely on disk."""
+        if self.writer is not None:
+            self.writer.join()
+
+    def writer_lag(self):
+        """Seconds of audio recorded but not yet written."""
+        if self.buffer is None:
+            return 0.0
+
+        return self.buffer.available / SAMPLE_RATE
 
     def callback(self, indata, frames, time, status):
         """Process an audio block (called asynchronously)."""
         if status:
-            print("audio status: {}".format(status))
-        else:
-            self.buffer.put(indata.copy())
+            count_status(self.metrics, "recorder", status)
+
+        # A flagged block is still audio, keep it
+        self.buffer.put(indata)
+
+class Comparer:
+    """Compares takes with the reference take in a worker process (see compare.py).
+
+    Only the latest comparison matters, so submitting another cancels the
+    one waiting, if it hasn't started.
+    """
+
+    def __init__(self):
+        # Spawned rather than forked, as this process has threads running
+        self.pool = concurrent.futures.ProcessPoolExecutor(1,
+                mp_context=multiprocessing.get_context("spawn"))
+        self.future = None
+        self.path = None
+        self.lines = []
+
+    def submit(self, path, reference):
+        if self.future is not None:
+            self.future.cancel()
+
+        self.path = path
+        self.future = self.pool.submit(compare, path, reference)
+        self.lines = ["comparing {} with {}".format(os.path.basename(path),
+                os.path.basename(reference))]
+
+    def poll(self):
+        if self.future is None or not self.future.done():
+            return
+
+        future, self.future = self.future, None
+        if future.cancelled():
+            return
+
+        try:
+            report = future.result()
+        except (OSError, RuntimeError, ValueError) as e:
+            self.lines = ["{}: {}".format(os.path.basename(self.path), e)]
+            return
+
+        self.lines = [os.path.basename(self.path)] + report.summary()
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+class Waveform:
+    """Min/max waveform of one take, drawn from its peaks file.
+
+    Peaks for takes recorded before peaks existed are built on a background
+    thread the first time the take is shown. The drawn waveform is kept and
+    only redrawn when the take, zoom or position changes.
+    """
+
+    def __init__(self, rect):
+        self.rect = rect
+        self.path = None
+        self.peaks = None
+        self.surface = None
+
+        # Fraction of the take shown, and where the view starts
+        self.zoom = 1.0
+        self.offset = 0.0
+
+        self.loaded = queue.Queue()
+        self.worker = LatestWorker(self.load)
+
+    def show(self, path):
+        while not self.loaded.empty():
+            loaded, peaks = self.loaded.get()
+            if loaded == self.path:
+                self.peaks = peaks
+                self.surface = None
+
+        if path == self.path:
+            return
+
+        self.path = path
+        self.peaks = None
+        self.surface = None
+        self.zoom = 1.0
+        self.offset = 0.0
+
+        self.worker.request(path)
+
+    def load(self, path):
+        try:
+            peaks = Peaks.load(path)
+        except (OSError, RuntimeError, ValueError):
+            peaks = None
+
+        self.loaded.put((path, peaks))
+
+    def zoom_by(self, factor):
+        center = self.offset + 0.5 / self.zoom
+
+        self.zoom = max(1.0, min(MAX_ZOOM, self.zoom * factor))
+        self.offset = max(0.0, min(1 - 1 / self.zoom, center - 0.5 / self.zoom))
+        self.surface = None
+
+    def pan(self, fraction):
+        """Move the view by a fraction of the take, or of the view when zoomed."""
+        self.offset = max(0.0, min(1 - 1 / self.zoom, self.offset + fraction / self.zoom))
+        self.surface = None
+
+    def draw(self, target, position=None):
+        if self.peaks is None or not self.peaks.frames:
+            return
+
+        if self.surface is None:
+            self.surface = self.render()
+
+        target.blit(self.surface, self.rect)
+
+        if position is not None:
+            start = self.offset * self.peaks.frames
+            x = int((position - start) / (self.peaks.frames / self.zoom) * self.rect.width)
+            if 0 <= x < self.rect.width:
+                pygame.draw.line(target, (255, 255, 255),
+                        (self.rect.left + x, self.rect.top), (self.rect.left + x, self.rect.bottom))
+
+    def render(self):
+        surface = pygame.Surface(self.rect.size)
+        surface.fill((16, 16, 16))
+
+        start = int(self.offset * self.peaks.frames)
+        end = start + int(self.peaks.frames / self.zoom)
+        columns = self.peaks.columns(start, end, self.rect.width)
+
+        half = self.rect.height / 2
+        ys = (half - columns * half).astype(int)
+        for x, (bottom, top) in enumerate(ys):
+            pygame.draw.line(surface, (64, 160, 96), (x, top), (x, bottom))
+
+        return surface
+
+def count_status(metrics, prefix, status):
+    for flag in ("input_overflow", "input_underflow", "output_overflow", "output_underflow"):
+        if getattr(status, flag, False):
+            metrics.count(prefix + "." + flag)
 
 if __name__ == "__main__":
     main()
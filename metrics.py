@@ -0,0 +1,117 @@
+"""Runtime counters, gauges and timing histograms.
+
+Shared by game.py and mem.py. Set METRICS_PATH in the environment to have
+snapshots written there as JSON every DUMP_INTERVAL seconds.
+"""
+
+import json
+import os
+import time
+
+DUMP_INTERVAL = 10
+
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKETS = (1, 2, 4, 8, 16, 33, 50, 100, 250, 1000)
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        i = 0
+        while i < len(BUCKETS) and ms > BUCKETS[i]:
+            i += 1
+
+        self.counts[i] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self):
+        return {
+            "buckets_ms": list(BUCKETS),
+            "counts": self.counts,
+            "count": self.count,
+            "mean_ms": self.mean,
+            "max_ms": self.max,
+        }
+
+class Metrics:
+
+    def __init__(self, path=None, interval=DUMP_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.last_dump = time.monotonic()
+
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    @staticmethod
+    def from_env():
+        return Metrics(os.environ.get("METRICS_PATH"))
+
+    def time(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+
+        histogram.add(seconds * 1000)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, fn):
+        """Register fn to be sampled whenever a snapshot is taken."""
+        self.gauges[name] = fn
+
+    def snapshot(self):
+        return {
+            "time": time.time(),
+            "histograms": dict((name, h.to_dict()) for name, h in self.histograms.items()),
+            "counters": dict(self.counters),
+            "gauges": dict((name, fn()) for name, fn in self.gauges.items()),
+        }
+
+    def tick(self):
+        """Dump a snapshot if one is due."""
+        if self.path is None or time.monotonic() - self.last_dump < self.interval:
+            return
+
+        self.dump()
+
+    def dump(self):
+        self.last_dump = time.monotonic()
+        if self.path is None:
+            return
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.snapshot(), f, indent=1)
+
+        os.replace(tmp, self.path)
+
+    def summary(self):
+        """Short human-readable lines for an on-screen overlay."""
+        lines = []
+        for name, h in sorted(self.histograms.items()):
+            lines.append("{} {:.1f}/{:.1f} ms x{}".format(name, h.mean, h.max, h.count))
+
+        for name, value in sorted(self.counters.items()):
+            lines.append("{} {}".format(name, value))
+
+        for name, fn in sorted(self.gauges.items()):
+            value = fn()
+            if isinstance(value, float):
+                value = "{:.3f}".format(value)
+            lines.append("{} {}".format(name, value))
+
+        return lines
@@ -0,0 +1,170 @@
+"""Min/max peak pyramids for drawing waveforms without decoding audio.
+
+Level 0 holds the min and max sample of every BLOCK frames, each level above
+reduces the one below by FACTOR. A pyramid is stored next to its take as
+<take>.peaks:
+
+    header   magic, version, sample rate, frames, block, number of levels
+    lengths  number of (min, max) pairs in each level
+    levels   int16 (min, max) pairs, level 0 first
+"""
+
+import os
+import struct
+
+import numpy as np
+import soundfile as sf
+
+MAGIC = b"OTPK"
+VERSION = 1
+
+HEADER = struct.Struct("<4sIIIII")
+
+BLOCK = 256
+FACTOR = 4
+
+# Stop building levels once one is this short
+MIN_LEVEL = 64
+
+def peaks_path(path):
+    return path + ".peaks"
+
+class PeakBuilder:
+    """Builds level 0 incrementally from blocks of frames, as they are written."""
+
+    def __init__(self, samplerate, block=BLOCK):
+        self.samplerate = samplerate
+        self.block = block
+        self.frames = 0
+
+        self.lo = np.empty(0, dtype="float32")
+        self.hi = np.empty(0, dtype="float32")
+        self.chunks = []
+
+    def add(self, frames):
+        self.frames += len(frames)
+
+        lo = np.concatenate([self.lo, frames.min(axis=1)])
+        hi = np.concatenate([self.hi, frames.max(axis=1)])
+
+        whole = len(lo) // self.block * self.block
+        if whole:
+            self.chunks.append(reduce_pairs(lo[:whole], hi[:whole], self.block))
+
+        self.lo = lo[whole:]
+        self.hi = hi[whole:]
+
+    def levels(self):
+        chunks = list(self.chunks)
+        if len(self.lo):
+            chunks.append(np.array([[self.lo.min(), self.hi.max()]], dtype="float32"))
+
+        level = np.concatenate(chunks) if chunks else np.zeros((0, 2), dtype="float32")
+        levels = [level]
+        while len(level) > MIN_LEVEL:
+            level = reduce_levels(level, FACTOR)
+            levels.append(level)
+
+        return levels
+
+    def save(self, path):
+        levels = [quantize(level) for level in self.levels()]
+
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.samplerate, self.frames,
+                    self.block, len(levels)))
+            f.write(struct.pack("<{}I".format(len(levels)), *[len(level) for level in levels]))
+            for level in levels:
+                f.write(level.tobytes())
+
+        os.replace(tmp, path)
+
+def reduce_pairs(lo, hi, n):
+    return np.stack([lo.reshape(-1, n).min(axis=1), hi.reshape(-1, n).max(axis=1)], axis=1)
+
+def reduce_levels(level, n):
+    # Pad with the last pair, which doesn't change its group's min or max
+    pad = -len(level) % n
+    if pad:
+        level = np.concatenate([level, np.repeat(level[-1:], pad, axis=0)])
+
+    return reduce_pairs(level[:, 0], level[:, 1], n)
+
+def quantize(level):
+    return np.clip(np.round(level * 32767), -32768, 32767).astype("<i2")
+
+class Peaks:
+    """Memory-mapped peak pyramid; only the columns that get drawn are read."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+            magic, version, self.samplerate, self.frames, self.block, count = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("not a peaks file")
+
+            lengths = struct.unpack("<{}I".format(count), f.read(4 * count))
+
+        self.levels = []
+        offset = HEADER.size + 4 * count
+        for length in lengths:
+            if length:
+                level = np.memmap(path, dtype="<i2", mode="r", offset=offset, shape=(length, 2))
+            else:
+                level = np.zeros((0, 2), dtype="<i2")
+
+            self.levels.append(level)
+            offset += length * 4
+
+    @staticmethod
+    def load(path):
+        """Open the peaks for an audio file, building them if missing or stale."""
+        sidecar = peaks_path(path)
+
+        try:
+            if os.path.getmtime(sidecar) >= os.path.getmtime(path):
+                return Peaks(sidecar)
+        except (OSError, ValueError):
+            pass
+
+        build(path)
+        return Peaks(sidecar)
+
+    def columns(self, start, end, width):
+        """Min and max in [-1, 1] for width columns spanning frames start to end."""
+        frames_per_column = max(1.0, (end - start) / width)
+
+        # Coarsest level that still has at least one pair per column
+        level_idx = 0
+        while (level_idx + 1 < len(self.levels) and
+                self.block * FACTOR ** (level_idx + 1) <= frames_per_column):
+            level_idx += 1
+
+        level = self.levels[level_idx]
+        span = self.block * FACTOR ** level_idx
+
+        first = min(start // span, len(level))
+        last = min(-(-end // span), len(level))
+        pairs = np.asarray(level[first:last], dtype="float32") / 32767
+
+        if not len(pairs):
+            return np.zeros((width, 2), dtype="float32")
+
+        # Spread the pairs across the columns; a column narrower than a pair
+        # repeats its neighbour's
+        starts = np.minimum(np.linspace(0, len(pairs), width, endpoint=False).astype(int),
+                len(pairs) - 1)
+
+        return np.stack([np.minimum.reduceat(pairs[:, 0], starts),
+                np.maximum.reduceat(pairs[:, 1], starts)], axis=1)
+
+def build(path, blocksize=65536):
+    """Compute and save the peaks for an existing take, reading it in blocks."""
+    info = sf.info(path)
+    builder = PeakBuilder(info.samplerate)
+
+    for block in sf.blocks(path, blocksize=blocksize, dtype="float32", always_2d=True):
+        builder.add(block)
+
+    builder.save(peaks_path(path))
@@ -8,9 +8,24 @@ import displayio
 import repeat
 import terminalio
 import analogjoy
+import gamepadshift
 from adafruit_display_text.label import Label
 import os
+import storage
+import sdcardio
 
+from cursor import CursorList
+from files import replace_file
+from scheduler import Scheduler
+
+SDCARD_PATH = "/sd"
+
+spi = board.SPI()
+cs = board.SD_CS
+
+sdcard = sdcardio.SDCard(spi, cs)
+vfs = storage.VfsFat(sdcard)
+storage.mount(vfs, SDCARD_PATH)
 
 speaker_enable = digitalio.DigitalInOut(board.SPEAKER_ENABLE)
 speaker_enable.switch_to_output(value=True)
@@ -23,6 +38,28 @@ down_key = repeat.KeyRepeat(lambda: joystick.down, rate=0.2)
 left_key = repeat.KeyRepeat(lambda: joystick.left, rate=0.2)
 right_key = repeat.KeyRepeat(lambda: joystick.right, rate=0.2)
 
+# Seconds between runs of each main loop task
+INPUT_INTERVAL = 0.02
+DISPLAY_INTERVAL = 0.1
+AUDIO_INTERVAL = 0.01
+
+# Seconds the selection has to rest before it starts playing
+PLAY_DEBOUNCE = 0.5
+
+# Decoder buffer, allocated once and reused for every track
+MP3_BUFFER_SIZE = 8192
+
+# Longest file name the label has room for
+MAX_GLYPHS = 64
+
+CATALOG_PATH = SDCARD_PATH + "/.catalog"
+
+# Kilobits per second by bitrate index, for MPEG 1 and MPEG 2/2.5 layer III
+MP3_BITRATES = (
+    (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+)
+
 BUTTON_SEL = const(8)
 BUTTON_START = const(4)
 BUTTON_A = const(2)
@@ -35,88 +72,298 @@ buttons = gamepadshift.GamePadShift(digitalio.DigitalInOut(board.BUTTON_CLOCK),
 def main():
     display = board.DISPLAY
 
-    mp3_paths = [d for d in os.listdir("/") if not d.startswith('.') and d.lower().endswith('.mp3')]
-    files = CursorList(sorted(mp3_paths))
-    play_audio(files.current)
+    catalog = Catalog.load(SDCARD_PATH, CATALOG_PATH)
+    catalog.refresh()
+    files = CursorList(catalog.names)
+
+    playlist = Playlist(files, SDCARD_PATH)
+    playlist.play(files.idx)
+
+    line = Label(terminalio.FONT, text=" ", color=(255, 192, 203), max_glyphs=MAX_GLYPHS)
+    line.y = 10
+
+    main_group = displayio.Group(max_size=1)
+    main_group.append(line)
+    display.show(main_group)
+
+    def show():
+        text = files.current[:MAX_GLYPHS]
+        if line.text != text:
+            line.text = text
 
-    while True:
+    scheduler = Scheduler()
+    refresh = scheduler.every(DISPLAY_INTERVAL, show)
+
+    def poll_input():
         joystick.poll()
 
         if up_key.value:
             files.back()
         elif down_key.value:
-            files.forward()
+            files.next()
+        else:
+            return
 
-        main_group = displayio.Group(max_size=25)
+        playlist.select()
+        scheduler.wake(refresh)
 
-        line = Label(terminalio.FONT, text=files.current, color=(255, 192, 203))
-        line.y = 10
-        main_group.append(line)
+    last_buttons = 0
 
-        display.show(main_group)
+    def poll_buttons():
+        nonlocal last_buttons
 
-        time.sleep(0.33)
+        pressed = buttons.get_pressed()
+        previous = last_buttons
+        last_buttons = pressed
 
+        # START rescans the card, for files copied on since the last boot
+        if pressed & BUTTON_START and not previous & BUTTON_START:
+            if catalog.refresh(force=True):
+                playlist.relist(catalog.names)
+                scheduler.wake(refresh)
 
-def play_audio(path):
-    stream = audiomp3.MP3Decoder(open(path, "rb"))
-    speaker.play(stream)
+    def service_audio():
+        if playlist.service():
+            scheduler.wake(refresh)
 
-class Button:
+    scheduler.every(INPUT_INTERVAL, poll_input)
+    scheduler.every(INPUT_INTERVAL, poll_buttons)
+    scheduler.every(AUDIO_INTERVAL, service_audio)
 
-    def __init__(self, pin):
-        btn = digitalio.DigitalInOut(board.SWITCH)
-        btn.direction = digitalio.Direction.INPUT
-        btn.pull = digitalio.Pull.UP
+    scheduler.run()
 
-        self.btn = btn
-        self.prev_state = False
-        self.cur_state = False
 
-    def poll(self):
-        self.cur_state = self.btn.value
-        pressed = self.cur_state != self.prev_state
+class Playlist:
+    """Plays the files of a cursor through one reused MP3Decoder.
+
+    Tracks are swapped into the decoder by assigning its file, so the decoder
+    and its buffer are only allocated once. The track after the playing one
+    is opened ahead of time, and plays as soon as the current one ends. A
+    new selection plays once the cursor has rested for PLAY_DEBOUNCE.
+    """
+
+    def __init__(self, files, base):
+        self.files = files
+        self.base = base
+        self.buffer = bytearray(MP3_BUFFER_SIZE)
+        self.decoder = None
+
+        self.playing_idx = None
+        self.playing_file = None
+
+        self.ahead_idx = None
+        self.ahead_file = None
+
+        self.selected_at = None
 
-class CursorList(list):
+    def select(self):
+        self.selected_at = time.monotonic()
 
-    def __init__(self, els):
-        self.idx = 0
-        super().__init__(els)
+    def open(self, idx):
+        if idx == self.ahead_idx:
+            f = self.ahead_file
+            self.ahead_idx = None
+            self.ahead_file = None
+            return f
 
-    def join(self, s=" "):
-        return s.join(self)
+        return open(self.base + "/" + self.files[idx], "rb")
 
-    def goto(self, pos):
-        if pos < 0:
-            self.idx = max(0, self.max_idx + pos)
+    def play(self, idx):
+        f = self.open(idx)
+
+        speaker.stop()
+        if self.decoder is None:
+            self.decoder = audiomp3.MP3Decoder(f, self.buffer)
         else:
-            self.idx = min(self.max_idx, pos)
+            self.decoder.file = f
+
+        if self.playing_file is not None:
+            self.playing_file.close()
+
+        self.playing_idx = idx
+        self.playing_file = f
+
+        speaker.play(self.decoder)
+
+        self.open_ahead()
+
+    def relist(self, names):
+        """Swap in a new listing, keeping the playing track and the selection."""
+        playing = self.files[self.playing_idx] if self.playing_idx is not None else None
+        selected = self.files.current
 
-        self.word_idx = 0
+        self.files.items = names
+        self.playing_idx = names.index(playing) if playing in names else None
+        self.files.goto(names.index(selected) if selected in names else self.files.idx)
+
+        if self.ahead_file is not None:
+            self.ahead_file.close()
+
+        self.ahead_idx = None
+        self.ahead_file = None
+        if self.playing_idx is not None:
+            self.open_ahead()
+
+    def open_ahead(self):
+        idx = self.playing_idx + 1
+        if idx > self.files.max_idx or idx == self.ahead_idx:
+            return
 
-    def next(self, count=1):
-        self.idx = min(self.max_idx, self.idx + count)
-        self.word_idx = 0
+        if self.ahead_file is not None:
+            self.ahead_file.close()
+
+        self.ahead_idx = idx
+        self.ahead_file = open(self.base + "/" + self.files[idx], "rb")
 
-    def back(self, count=1):
-        self.idx = max(0, self.idx - count)
-        self.word_idx = 0
+    def service(self):
+        """Start the selection or the next track; return whether the cursor moved."""
+        if self.selected_at is not None:
+            if time.monotonic() - self.selected_at < PLAY_DEBOUNCE:
+                return False
 
-    @property
-    def peek_next(self):
-        if self.idx == self.max_idx:
-            return None
+            self.selected_at = None
+            if self.files.idx != self.playing_idx:
+                self.play(self.files.idx)
 
-        return self[self.idx + 1]
+            return False
+
+        if speaker.playing or self.playing_idx is None:
+            return False
+
+        idx = self.playing_idx + 1
+        if idx > self.files.max_idx:
+            return False
+
+        # Follow along unless the user has browsed away
+        moved = self.files.idx == self.playing_idx
+        if moved:
+            self.files.goto(idx)
+
+        self.play(idx)
+
+        return moved
+
+class Catalog:
+    """Sorted listing of the MP3s in a directory, cached on the card.
+
+    The cache has one "name<TAB>size<TAB>seconds" line per file. FAT
+    directory mtimes can't be trusted (the card's root has none), so every
+    refresh lists the directory, but only files missing from the cache are
+    opened to estimate their length. refresh(force=True) also checks the
+    size of every file, to catch one replaced under the same name.
+    """
+
+    def __init__(self, base, path):
+        self.base = base
+        self.path = path
+        self.names = []
+        self.sizes = []
+        self.durations = []
+
+    def load(base, path):
+        catalog = Catalog(base, path)
+
+        try:
+            with open(path, "r") as f:
+                for line in f:
+                    name, size, duration = line.rstrip("\n").split("\t")
+                    catalog.names.append(name)
+                    catalog.sizes.append(int(size))
+                    catalog.durations.append(float(duration))
+        except (OSError, ValueError):
+            return Catalog(base, path)
+
+        return catalog
+
+    def refresh(self, force=False):
+        """List the directory again; return whether anything changed."""
+        names = sorted([d for d in os.listdir(self.base)
+                if not d.startswith('.') and d.lower().endswith('.mp3')])
+
+        if not force and names == self.names:
+            return False
+
+        known = {}
+        for name, size, duration in zip(self.names, self.sizes, self.durations):
+            known[name] = (size, duration)
+
+        sizes = []
+        durations = []
+        for name in names:
+            cached = known.get(name)
+            if cached is not None and not force:
+                size, duration = cached
+            else:
+                path = self.base + "/" + name
+                size = os.stat(path)[6]
+
+                if cached is not None and cached[0] == size:
+                    duration = cached[1]
+                else:
+                    duration = mp3_duration(path, size)
+
+            sizes.append(size)
+            durations.append(duration)
+
+        if names == self.names and sizes == self.sizes:
+            return False
+
+        self.names = names
+        self.sizes = sizes
+        self.durations = durations
+        self.save()
+
+        return True
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for name, size, duration in zip(self.names, self.sizes, self.durations):
+                f.write("{}\t{}\t{:.1f}\n".format(name, size, duration))
+
+        replace_file(tmp, self.path)
+
+def mp3_duration(path, size):
+    """Estimate seconds from the first frame's bitrate; exact for CBR files."""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(10)
+            offset = 0
+            if head[:3] == b"ID3":
+                # Syncsafe tag size, 7 bits per byte
+                offset = 10 + ((head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9])
+
+            f.seek(offset)
+            block = f.read(4096)
+    except OSError:
+        return 0.0
+
+    for i in range(len(block) - 3):
+        if block[i] != 0xFF or block[i + 1] & 0xE0 != 0xE0:
+            continue
+
+        index = block[i + 2] >> 4
+        if 0 < index < 15:
+            mpeg1 = block[i + 1] & 0x18 == 0x18
+            bitrate = MP3_BITRATES[0 if mpeg1 else 1][index]
+            return (size - offset - i) * 8 / (bitrate * 1000)
+
+    return 0.0
 
-    @property
-    def current(self):
-        return self[self.idx]
+class Button:
+
+    def __init__(self, pin):
+        btn = digitalio.DigitalInOut(board.SWITCH)
+        btn.direction = digitalio.Direction.INPUT
+        btn.pull = digitalio.Pull.UP
 
-    @property
-    def max_idx(self):
-        return len(self) - 1
+        self.btn = btn
+        self.prev_state = False
+        self.cur_state = False
 
+    def poll(self):
+        self.cur_state = self.btn.value
+        pressed = self.cur_state != self.prev_state
 
 if __name__ == "__main__":
     main()
@@ -13,6 +13,10 @@ import os
 import storage
 import sdcardio
 
+import corpus_index
+from cursor import Cursor, CursorList
+from files import replace_file
+from scheduler import Scheduler
 from adafruit_display_text.label import Label
 
 SDCARD_PATH = "/sd"
@@ -33,17 +37,32 @@ down_key = repeat.KeyRepeat(lambda: joystick.down, rate=0.2)
 left_key = repeat.KeyRepeat(lambda: joystick.left, rate=0.2)
 right_key = repeat.KeyRepeat(lambda: joystick.right, rate=0.2)
 
-def main():
-    with open("/foundation.txt", "r") as f:
-        lines = f.readlines()
+# Seconds without a change before pending writes go to the card, and the
+# longest they may wait while changes keep coming
+FLUSH_DEBOUNCE = 2.0
+FLUSH_MAX_DELAY = 10.0
+
+# Log entries to allow before folding them into the snapshot
+COMPACT_AFTER = 64
 
-    verses = make_pager(lines, max_width=26, max_height=7)
+# Seconds between runs of each main loop task
+INPUT_INTERVAL = 0.02
+DISPLAY_INTERVAL = 0.1
+FLUSH_INTERVAL = 0.5
+
+def main():
+    # The flash root is read-only to us, so the index lives on the card
+    index = corpus_index.load("/foundation.txt", max_width=26, max_height=7,
+            pager=corpus_index.make_pager, index_path=SDCARD_PATH + "/foundation.txt.idx")
+    verses = Pages(index)
 
     data = Data.load(SDCARD_PATH + "/data.json")
     mode = TextReader(data, verses)
-    data.save()
 
-    while True:
+    scheduler = Scheduler()
+    refresh = scheduler.every(DISPLAY_INTERVAL, mode.show)
+
+    def poll_input():
         joystick.poll()
 
         if up_key.value:
@@ -54,21 +73,54 @@ def main():
             mode.btn_left()
         elif right_key.value:
             mode.btn_right()
+        else:
+            return
+
+        scheduler.wake(refresh)
+
+    scheduler.every(INPUT_INTERVAL, poll_input)
+    scheduler.every(FLUSH_INTERVAL, data.tick)
 
-        mode.show()
+    scheduler.run()
 
 class Data:
+    """Write-behind key/value store.
+
+    store() only updates memory. tick() appends the latest value of each
+    changed key to <path>.log once changes have settled, and every
+    COMPACT_AFTER entries the log is folded into the JSON snapshot at path,
+    written to a temp file and renamed into place.
+    """
+
     def __init__(self, path):
         self.path = path
         self.data = {}
 
+        self.pending = {}
+        self.first_change = None
+        self.last_change = None
+        self.logged = 0
+
+    @property
+    def log_path(self):
+        return self.path + ".log"
+
+    @property
+    def tmp_path(self):
+        return self.path + ".tmp"
+
     def store(self, caller, key, value):
         namespace = self.namespace(caller)
 
         self.data.setdefault(namespace, {})
         self.data[namespace][key] = value
 
-        self.save()
+        self.pending[(namespace, key)] = value
+
+        now = time.monotonic()
+        if self.first_change is None:
+            self.first_change = now
+        self.last_change = now
 
     def get(self, caller, key, default=None):
         namespace = self.namespace(caller)
@@ -83,20 +135,81 @@ class Data:
     def load(path):
         data = Data(path)
 
-        try:
-            with open(path, "r") as f:
-                j = f.read()
-        except OSError as e:
-            j = "{}"
+        j = "{}"
+        # A compaction may have been cut off between removing the old
+        # snapshot and renaming the new one
+        for snapshot in (path, data.tmp_path):
+            try:
+                with open(snapshot, "r") as f:
+                    j = f.read()
+                break
+            except OSError:
+                pass
 
         data.data = json.loads(j)
 
+        torn = False
+        try:
+            with open(data.log_path, "r") as f:
+                for line in f:
+                    try:
+                        namespace, key, value = json.loads(line)
+                    except ValueError:
+                        torn = True
+                        break
+
+                    data.data.setdefault(namespace, {})[key] = value
+                    data.logged += 1
+        except OSError:
+            pass
+
+        # Appending after a torn write would corrupt the next entry too
+        if torn:
+            data.compact()
+
         return data
 
-    def save(self):
-        with open(self.path, "w") as f:
+    def tick(self):
+        """Flush pending changes if they have settled or waited long enough."""
+        if not self.pending:
+            return
+
+        now = time.monotonic()
+        if (now - self.last_change < FLUSH_DEBOUNCE and
+                now - self.first_change < FLUSH_MAX_DELAY):
+            return
+
+        self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        with open(self.log_path, "a") as f:
+            for (namespace, key), value in self.pending.items():
+                f.write(json.dumps([namespace, key, value]) + "\n")
+
+        self.logged += len(self.pending)
+        self.pending = {}
+        self.first_change = None
+        self.last_change = None
+
+        if self.logged >= COMPACT_AFTER:
+            self.compact()
+
+    def compact(self):
+        with open(self.tmp_path, "w") as f:
             json.dump(self.data, f)
 
+        replace_file(self.tmp_path, self.path)
+
+        try:
+            os.remove(self.log_path)
+        except OSError:
+            pass
+
+        self.logged = 0
+
 class Mode:
 
     def __init__(self, data):
@@ -131,6 +244,17 @@ class TextReader(Mode):
         self.verses = verses
         self.verses.goto(self.data.get(self, "verse", 0))
 
+        # Built once; show() only swaps the label's text
+        self.label = Label(terminalio.FONT, text=" ", color=(255, 192, 203),
+                max_glyphs=verses.max_glyphs)
+        self.label.y = 10
+
+        self.group = displayio.Group(max_size=1)
+        self.group.append(self.label)
+        display.show(self.group)
+
+        self.shown = None
+
     def btn_left(self):
         self.states.back()
 
@@ -146,30 +270,19 @@ class TextReader(Mode):
         self.data.store(self, "verse", self.verses.idx)
 
     def show(self):
-        text = self.verses.current
+        shown = (self.verses.idx, self.states.current)
+        if shown == self.shown:
+            return
+
         if self.states.current == self.FULL:
-            pass
+            text = self.verses.current
         elif self.states.current == self.INITIALS:
-            initials = ""
-            last_space = True
-            for current in text:
-                is_space = current in [" ", "\n"]
-                if last_space or is_space:
-                    initials += current
-
-                last_space = is_space
-
-            text = initials
+            text = self.verses.current_initials
         elif self.states.current == self.BLANK:
             text = " "
 
-        main_group = displayio.Group(max_size=25)
-
-        line = Label(terminalio.FONT, text=text, color=(255, 192, 203))
-        line.y = 10
-        main_group.append(line)
-
-        display.show(main_group)
+        self.label.text = text
+        self.shown = shown
 
 class Button:
 
@@ -186,86 +299,29 @@ class Button:
         self.cur_state = self.btn.value
         pressed = self.cur_state != self.prev_state
 
-def make_pager(lines, max_width, max_height):
-    lines = [line.strip() for line in lines]
-
-    pages = []
-    block = ""
-    chunk = ""
-    for line in lines:
-        idx = 0
-        space_chunk_idx = 0
-        space_line_idx = 0
+class Pages(Cursor):
+    """Cursor over the pages of a corpus index, read from the card on demand."""
 
-        if len(line) == 0:
-            line = [" "]
+    __slots__ = ("index", "idx")
 
-        while idx < len(line):
-            current = line[idx]
-            idx += 1
-            chunk += current
-            if current == " ":
-                space_chunk_idx = len(chunk) - 1
-                space_line_idx = idx - 1
-
-            # We exceeded our chunk limit, rewind
-            if len(chunk) > max_width:
-                block += chunk[:space_chunk_idx] + "\n"
-                chunk = ""
-                idx = space_line_idx
-
-            if block.count("\n") >= max_height:
-                pages.append(block)
-                block = ""
-
-        if chunk != "":
-            block += chunk + "\n"
-            chunk = ""
-
-    if block != "":
-        pages.append(block)
-
-    return CursorList(pages)
-
-class CursorList(list):
-
-    def __init__(self, els):
+    def __init__(self, index):
+        self.index = index
         self.idx = 0
-        super().__init__(els)
 
-    def join(self, s=" "):
-        return s.join(self)
-
-    def goto(self, pos):
-        if pos < 0:
-            self.idx = max(0, self.max_idx + pos)
-        else:
-            self.idx = min(self.max_idx, pos)
-
-        self.word_idx = 0
-
-    def next(self, count=1):
-        self.idx = min(self.max_idx, self.idx + count)
-        self.word_idx = 0
-
-    def back(self, count=1):
-        self.idx = max(0, self.idx - count)
-        self.word_idx = 0
-
-    @property
-    def peek_next(self):
-        if self.idx == self.max_idx:
-            return None
+    def __len__(self):
+        return self.index.page_count
 
-        return self[self.idx + 1]
+    def __getitem__(self, i):
+        return self.index.page(i)
 
     @property
-    def current(self):
-        return self[self.idx]
+    def current_initials(self):
+        return self.index.page_initials(self.idx)
 
     @property
-    def max_idx(self):
-        return len(self) - 1
+    def max_glyphs(self):
+        # Every row can be full and ends in a newline
+        return (self.index.max_width + 1) * self.index.max_height
 
 if __name__ == "__main__":
     main()
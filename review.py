@@ -0,0 +1,130 @@
+"""SM-2 spaced repetition over the lines and words of a corpus.
+
+Cards are keyed by line and word index, so the review file starts with the
+crc32 of the corpus it was made for, as stored in its corpus index. Once
+the text changes the indexes may point at other lines, and the old cards
+are dropped rather than moved onto them.
+"""
+
+import heapq
+import os
+import struct
+import time
+
+MAGIC = b"SRQ1"
+
+# magic, corpus crc32
+HEADER = struct.Struct("<4sI")
+
+# line, word (-1 for the whole line), ease, interval in days, repetitions, due
+RECORD = struct.Struct("<iiffid")
+
+DAY = 24 * 60 * 60
+
+# Days until a forgotten item comes back
+LAPSE_INTERVAL = 10 / (24 * 60)
+
+class Card:
+
+    __slots__ = ("ease", "interval", "reps", "due")
+
+    def __init__(self, ease=2.5, interval=0.0, reps=0, due=0.0):
+        self.ease = ease
+        self.interval = interval
+        self.reps = reps
+        self.due = due
+
+    def grade(self, quality, now):
+        """Update from a 0-5 recall quality, as in SM-2."""
+        if quality < 3:
+            self.reps = 0
+            self.interval = LAPSE_INTERVAL
+        else:
+            self.reps += 1
+            if self.reps == 1:
+                self.interval = 1.0
+            elif self.reps == 2:
+                self.interval = 6.0
+            else:
+                self.interval *= self.ease
+
+        miss = 5 - quality
+        self.ease = max(1.3, self.ease + 0.1 - miss * (0.08 + miss * 0.02))
+        self.due = now + self.interval * DAY
+
+class ReviewQueue:
+    """Cards keyed by (line, word), with the due ones kept in a heap.
+
+    Regrading a card pushes a new heap entry rather than searching for the
+    old one; stale entries are skipped when they reach the top.
+    """
+
+    def __init__(self, path=None, crc=0):
+        self.path = path
+        self.crc = crc
+        self.cards = {}
+        self.heap = []
+        self.unsaved = 0
+
+    @staticmethod
+    def load(path, crc):
+        queue = ReviewQueue(path, crc)
+
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return queue
+
+        if data[:HEADER.size] != HEADER.pack(MAGIC, crc):
+            # Made for another version of the corpus, or another format
+            return queue
+
+        for line, word, ease, interval, reps, due in RECORD.iter_unpack(data[HEADER.size:]):
+            queue.cards[(line, word)] = Card(ease, interval, reps, due)
+
+        queue.heap = [(card.due, key) for key, card in queue.cards.items()]
+        heapq.heapify(queue.heap)
+
+        return queue
+
+    def save(self):
+        if self.path is None:
+            return
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, self.crc))
+            for (line, word), card in self.cards.items():
+                f.write(RECORD.pack(line, word, card.ease, card.interval, card.reps, card.due))
+
+        os.replace(tmp, self.path)
+        self.unsaved = 0
+
+    def record(self, line, word, quality, now=None):
+        """Grade the word of a line, or the whole line when word is -1."""
+        now = time.time() if now is None else now
+        key = (line, word)
+
+        card = self.cards.get(key)
+        if card is None:
+            card = self.cards[key] = Card()
+
+        card.grade(quality, now)
+        heapq.heappush(self.heap, (card.due, key))
+
+        self.unsaved += 1
+
+    def next_due(self, now=None):
+        """Return the (line, word) key of the most overdue card, or None."""
+        now = time.time() if now is None else now
+
+        while self.heap:
+            due, key = self.heap[0]
+            if self.cards[key].due != due:
+                heapq.heappop(self.heap)
+                continue
+
+            return key if due <= now else None
+
+        return None
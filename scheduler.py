@@ -0,0 +1,52 @@
+"""Cooperative scheduler for the handheld main loops.
+
+Shared by the pygamer scripts (copy it to the device along with them). Each
+task is a plain function run every interval seconds, and the loop sleeps
+until the next one is due, so it runs on CircuitPython without asyncio.
+"""
+
+import time
+
+class Task:
+
+    def __init__(self, interval, fn):
+        self.interval = interval
+        self.fn = fn
+        self.due = time.monotonic()
+
+class Scheduler:
+    """Runs tasks at their own rates from a single loop.
+
+    Between runs the loop sleeps until the next task is due, so polling
+    input quickly doesn't mean spinning. wake() makes a task due right away,
+    e.g. to redraw as soon as a key is handled instead of on the next display
+    tick.
+    """
+
+    def __init__(self):
+        self.tasks = []
+
+    def every(self, interval, fn):
+        task = Task(interval, fn)
+        self.tasks.append(task)
+
+        return task
+
+    def wake(self, task):
+        task.due = time.monotonic()
+
+    def run_due(self):
+        for task in self.tasks:
+            now = time.monotonic()
+            if now >= task.due:
+                task.fn()
+                # Don't try to catch up on missed runs
+                task.due = max(task.due + task.interval, now)
+
+    def run(self):
+        while True:
+            self.run_due()
+
+            delay = min(task.due for task in self.tasks) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
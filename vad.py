@@ -0,0 +1,193 @@
+"""Streaming voice-activity detection, for trimming and splitting takes.
+
+Audio is classified in FRAME_SECONDS frames by energy against a noise floor.
+The floor drops at once to any quieter frame, and only rises during frames
+already classified as silence, so a long unbroken stretch of voice can't
+lift it to the voice's own level. Frames with many zero crossings need less
+energy, so quiet fricatives count as speech.
+"""
+
+import collections
+
+import numpy as np
+
+FRAME_SECONDS = 0.01
+
+# Energy above the noise floor for a frame to be speech
+MARGIN_DB = 12
+FRICATIVE_MARGIN_DB = 6
+FRICATIVE_ZCR = 0.25
+
+# How fast the floor may rise during silence, so it follows slowly changing
+# background noise
+FLOOR_RISE_DB = 3
+
+# Digital silence is treated as this loud
+MIN_DB = -80
+
+# Silence kept before speech starts and after it stops
+PAD_SECONDS = 0.25
+
+# Longer silences end a segment, or are cut down to the padding
+PAUSE_SECONDS = 1.5
+
+class Detector:
+
+    def __init__(self, samplerate):
+        self.frame = int(samplerate * FRAME_SECONDS)
+        self.rise = FLOOR_RISE_DB * FRAME_SECONDS
+        self.floor = None
+
+    def classify(self, frames):
+        """Whether each of frames, shaped (n, frame, channels), is speech."""
+        mono = frames.mean(axis=2)
+
+        db = 10 * np.log10(np.maximum(np.mean(mono * mono, axis=1), 10 ** (MIN_DB / 10)))
+
+        signs = np.signbit(mono)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (self.frame - 1)
+
+        margin = np.where(zcr > FRICATIVE_ZCR, FRICATIVE_MARGIN_DB, MARGIN_DB)
+
+        # Each frame's label decides whether the floor may rise after it, so
+        # this runs frame by frame, a hundred per second of audio
+        speech = np.zeros(len(db), dtype=bool)
+        floor = db[0] if self.floor is None else self.floor
+        for i, (level, above) in enumerate(zip(db.tolist(), margin.tolist())):
+            floor = min(floor, level)
+            if level > floor + above:
+                speech[i] = True
+            else:
+                floor += self.rise
+
+        self.floor = floor
+
+        return speech
+
+class Segmenter:
+    """Writes only the speech from a stream of blocks, padded with a little silence.
+
+    open_segment() returns what a segment is written to: anything with
+    write(block) and close(). Pauses longer than PAUSE_SECONDS are cut down
+    to the padding, or with split=True end the segment, so the next speech
+    goes to a newly opened one. At least one segment is always opened, even
+    if it is closed without anything written to it.
+    """
+
+    def __init__(self, samplerate, channels, open_segment, split=False):
+        self.detector = Detector(samplerate)
+        self.open_segment = open_segment
+        self.split = split
+
+        self.pad = int(samplerate * PAD_SECONDS)
+        self.pause = int(samplerate * PAUSE_SECONDS)
+
+        # Frames not yet classified, less than one detector frame
+        self.carry = np.zeros((0, channels), dtype="float32")
+
+        self.segment = None
+        self.segments = 0
+        self.speaking = False
+
+        # Silence before speech, only the last pad frames of which are kept
+        self.before = collections.deque()
+        self.before_frames = 0
+
+        # Silence since speech stopped, written if speech resumes soon enough
+        self.after = []
+        self.after_frames = 0
+
+        self.trimmed = 0
+
+    def write(self, block):
+        frame = self.detector.frame
+
+        data = np.concatenate([self.carry, block])
+        n = len(data) // frame
+        self.carry = data[n * frame:]
+        if not n:
+            return
+
+        voiced = self.detector.classify(data[:n * frame].reshape(n, frame, -1))
+
+        # Handle runs of frames with the same label at once
+        bounds = [0] + list(np.flatnonzero(np.diff(voiced)) + 1) + [n]
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            chunk = data[a * frame:b * frame]
+            if voiced[a]:
+                self.speech(chunk)
+            else:
+                self.silence(chunk)
+
+    def speech(self, chunk):
+        if self.speaking:
+            self.flush(self.after)
+            self.after_frames = 0
+        else:
+            if self.segment is None:
+                self.segment = self.open_segment()
+                self.segments += 1
+
+            self.flush(self.before)
+            self.before_frames = 0
+
+        self.segment.write(chunk)
+        self.speaking = True
+
+    def silence(self, chunk):
+        if not self.speaking:
+            self.keep_before(chunk)
+            return
+
+        self.after.append(chunk)
+        self.after_frames += len(chunk)
+
+        if self.after_frames > self.pause:
+            self.end_speech()
+
+    def keep_before(self, chunk):
+        self.before.append(chunk)
+        self.before_frames += len(chunk)
+
+        excess = self.before_frames - self.pad
+        while excess > 0:
+            first = self.before[0]
+            if len(first) <= excess:
+                self.before.popleft()
+            else:
+                self.before[0] = first[excess:]
+
+            dropped = min(len(first), excess)
+            self.trimmed += dropped
+            self.before_frames -= dropped
+            excess -= dropped
+
+    def end_speech(self):
+        silence = np.concatenate(self.after) if self.after else self.carry[:0]
+        self.after = []
+        self.after_frames = 0
+        self.speaking = False
+
+        self.segment.write(silence[:self.pad])
+        self.keep_before(silence[self.pad:])
+
+        if self.split:
+            self.segment.close()
+            self.segment = None
+
+    def flush(self, chunks):
+        for chunk in chunks:
+            self.segment.write(chunk)
+
+        chunks.clear()
+
+    def close(self):
+        if self.speaking:
+            self.end_speech()
+
+        self.trimmed += len(self.carry) + self.before_frames
+
+        if self.segment is not None:
+            self.segment.close()
+        elif not self.segments:
+            self.open_segment().close()